@@ -0,0 +1,342 @@
+#===============================================================================
+# Benchmark for gpxcorrelate. Generates synthetic gpx tracks (configurable
+# number of points, devices and extension tags) and minimal JPEGs with EXIF
+# timestamps in a temporary directory, then times every stage: gpx parsing,
+# track cache loading, index building, correlation, EXIF reading and writing,
+# time offset estimation, place cache lookups and geocoding. exiv2 and
+# Nominatim are replaced by local stubs (a no-op exiv2 script on the PATH and
+# a local HTTP server), so the benchmark runs offline and does not touch any
+# real photos.
+#
+# usage: python3 benchmark.py [points=<n>] [devices=<n>] [images=<n>]
+#        [tags=<tag,tag>] [places=<n>] [output=<json file>]
+#        [baseline=<json file>] [tolerance=<factor>]
+# Results are printed and written as json to output=. With baseline=, every
+# stage is compared to a stored result file and the exit code is 1 if a stage
+# got slower than tolerance (default 1.3) times its baseline. Every stage
+# checks its results (images matched and written, places resolved, ...); if
+# one fails, the benchmark stops with exit code 2 instead of timing an error
+# path.
+#===============================================================================
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import logging
+import tempfile
+import threading
+import http.server
+import urllib.parse
+
+import gpxcorrelate
+import gps2name
+import trackcache
+
+def generate_gpx(path, start, points, step=1, tags=(), lat=47.5, lon=8.5, seed=0):
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<gpx version="1.1" creator="benchmark" xmlns="{}" xmlns:gpxtpx="{}">\n'.format(gpxcorrelate.Nsp["gpx"], gpxcorrelate.Nsp["gpxtpx"]))
+        f.write('<trk><name>{}</name><trkseg>\n'.format(os.path.basename(path)))
+        for i in range(points):
+            lat += rnd.uniform(-1e-4, 1e-4)
+            lon += rnd.uniform(-1e-4, 1e-4)
+            ts = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start + i * step))
+            f.write('<trkpt lat="{:.7f}" lon="{:.7f}"><ele>{:.1f}</ele><time>{}</time>'.format(lat, lon, 400 + 50 * rnd.random(), ts))
+            if tags:
+                f.write('<extensions><gpxtpx:TrackPointExtension>')
+                for tag in tags:
+                    f.write('<gpxtpx:{0}>{1}</gpxtpx:{0}>'.format(tag, rnd.randint(10, 180)))
+                #end for
+                f.write('</gpxtpx:TrackPointExtension></extensions>')
+            #end if
+            f.write('</trkpt>\n')
+        #end for
+        f.write('</trkseg></trk></gpx>\n')
+    #end with
+#end def
+
+def tiff_ifd(entries, offset):
+    data = b""
+    table = struct.pack("<H", len(entries))
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    for tag, ftype, count, raw in sorted(entries):
+        if len(raw) <= 4:
+            table += struct.pack("<HHL", tag, ftype, count) + raw.ljust(4, b"\0")
+        else:
+            table += struct.pack("<HHLL", tag, ftype, count, data_offset + len(data))
+            data += raw + b"\0" * (len(raw) % 2)
+        #end if
+    #end for
+    return table + b"\0\0\0\0" + data
+#end def
+
+# Writes a minimal JPEG that only consists of an APP1 segment with
+# DateTimeOriginal (and optionally UserComment) in the Exif IFD.
+def generate_jpeg(path, timestamp, comment=None):
+    exif = [(0x9003, 2, 20, time.strftime("%Y:%m:%d %H:%M:%S", time.gmtime(timestamp)).encode() + b"\0")]
+    if comment:
+        raw = b"ASCII\0\0\0" + comment.encode()
+        exif.append((0x9286, 7, len(raw), raw))
+    #end if
+    exif_offset = 8 + 2 + 12 + 4
+    ifd0 = tiff_ifd([(0x8769, 4, 1, struct.pack("<L", exif_offset))], 8)
+    tiff = b"II*\0" + struct.pack("<L", 8) + ifd0 + tiff_ifd(exif, exif_offset)
+    app1 = b"Exif\0\0" + tiff
+    with open(path, "wb") as f:
+        f.write(b"\xff\xd8\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xd9")
+    #end with
+#end def
+
+def stub_exiv2(folder):
+    script = os.path.join(folder, "exiv2")
+    with open(script, "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    #end with
+    os.chmod(script, 0o755)
+    os.environ["PATH"] = folder + os.pathsep + os.environ["PATH"]
+#end def
+
+class StubNominatim(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        lat, lon = float(query["lat"]), float(query["lon"])
+        body = json.dumps({
+            "place_id": 0, "lat": str(lat), "lon": str(lon),
+            "display_name": "Place {:.3f} {:.3f}".format(lat, lon),
+            "boundingbox": [str(lat - 0.001), str(lat + 0.001), str(lon - 0.001), str(lon + 0.001)],
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    #end def
+    def log_message(self, *args):
+        pass
+    #end def
+#end class
+
+def stub_nominatim():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubNominatim)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/reverse".format(server.server_address[1])
+#end def
+
+class BenchmarkError(Exception):
+    pass
+#end class
+
+# check for correlate_many() results: every image has a track point
+def all_matched(results):
+    unmatched = sum(1 for r in results if r is None or r[0] is None)
+    return "{} of {} images not matched".format(unmatched, len(results)) if unmatched else None
+#end def
+
+class Timer:
+    def __init__(self):
+        self.results = {}
+        self.out = sys.stdout
+    #end def
+    # check: optional function result -> error message or None; a stage that
+    # failed is not reported, so it cannot pass as fast against a baseline
+    def run(self, stage, items, func, *args, check=None, **kwargs):
+        t0 = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - t0
+        error = check(result) if check is not None else None
+        if error is not None:
+            raise BenchmarkError("{}: {}".format(stage, error))
+        #end if
+        self.results[stage] = {"seconds": seconds, "items": items, "per_second": items / max(seconds, 1e-9)}
+        print("{:16s} {:10.4f}s {:10d} items {:14.0f} /s".format(stage, seconds, items, items / max(seconds, 1e-9)), file=self.out)
+        return result
+    #end def
+#end class
+
+def run(options):
+    points = int(options["points"])
+    devices = int(options["devices"])
+    images = int(options["images"])
+    places = int(options["places"])
+    tags = [t for t in options["tags"].split(",") if t]
+    folder = tempfile.mkdtemp(prefix="gpxbench")
+    timer = Timer()
+    try:
+        stub_exiv2(folder)
+        start = 1500000000
+        gpxfiles = []
+        for device in range(devices):
+            gpxfile = os.path.join(folder, "device{}.gpx".format(device))
+            generate_gpx(gpxfile, start + device * 7, points // devices, step=devices, tags=tags, seed=device)
+            gpxfiles.append(gpxfile)
+        #end for
+        rnd = random.Random(1)
+        imagefiles = []
+        for n in range(images):
+            imagefile = os.path.join(folder, "img{:06d}.jpg".format(n))
+            generate_jpeg(imagefile, start + rnd.randint(0, points), comment=["", "benchmark"][n % 2])
+            imagefiles.append(imagefile)
+        #end for
+
+        gpxdata = gpxcorrelate.GPXData(0, 0)
+        def parse():
+            for gpxfile in gpxfiles:
+                gpxdata.add_file(gpxfile, tags=tags)
+            #end for
+        #end def
+        timer.run("parse", points, parse)
+        cache = trackcache.TrackCache(path=os.path.join(folder, "tracks"))
+        for gpxfile in gpxfiles:
+            gpxcorrelate.GPXData(0, 0).add_file(gpxfile, tags=tags, cache=cache)
+        #end for
+        def load_cached():
+            cached = gpxcorrelate.GPXData(0, 0)
+            for gpxfile in gpxfiles:
+                cached.add_file(gpxfile, tags=tags, cache=cache)
+            #end for
+            return cache.hits
+        #end def
+        hits = cache.hits
+        timer.run("cache_load", points, load_cached,
+            check=lambda n: None if n - hits == len(gpxfiles) else "{} of {} tracks loaded from the cache".format(n - hits, len(gpxfiles)))
+        timer.run("index", len(gpxdata.segment), gpxdata.build_index)
+        timer.run("exif_read", images, lambda: [gpxcorrelate.get_exiv2(image) for image in imagefiles],
+            check=lambda exifs: None if all(exif and 'DateTimeOriginal' in exif for exif in exifs) else "DateTimeOriginal not read")
+        writer = gpxcorrelate.ExivWriter()
+        results = timer.run("correlate", images, gpxdata.correlate_many, imagefiles, maxdiff=300, writer=writer, check=all_matched)
+        timer.run("interpolate", images, gpxdata.correlate_many, imagefiles, maxdiff=300, interpolate="spline", writer=gpxcorrelate.ExivWriter(), check=all_matched)
+        for n, image in enumerate(imagefiles):
+            writer.set_comment(image, "comment {}".format(n))
+        #end for
+        timer.run("exif_write", len(writer), writer.flush,
+            check=lambda written: None if list(written.values()).count("WRITTEN") == images else "not all images written")
+
+        # to=auto on tracks with gaps (one 8 hour trip per day), with every
+        # 50th photo already carrying coordinates and the camera 437s ahead
+        trips = gpxcorrelate.GPXData(0, 0)
+        for day in range(5):
+            gpxfile = os.path.join(folder, "trip{}.gpx".format(day))
+            generate_gpx(gpxfile, start + day * 86400, 8 * 720, step=5, seed=day)
+            trips.add_file(gpxfile)
+        #end for
+        trips.build_index()
+        true_times = [start + rnd.randint(0, 4) * 86400 + rnd.randint(0, 8 * 3600 - 1) for n in range(images)]
+        anchors = [None] * images
+        for n, (m, state) in enumerate(trips.match(true_times, 300)):
+            if n % 50 == 0 and m is not None:
+                anchors[n] = (m[1].lats[m[2]], m[1].lons[m[2]])
+            #end if
+        #end for
+        def offset_found(estimate):
+            if estimate is None or abs(estimate[0] - 437) > 5:
+                return "estimated {} instead of 437s".format(None if estimate is None else estimate[0])
+            #end if
+            if estimate[3] < gpxcorrelate.Auto_offset_confidence:
+                return "confidence {:.3f} below {}".format(estimate[3], gpxcorrelate.Auto_offset_confidence)
+            #end if
+            return None
+        #end def
+        timer.run("estimate_offset", images, trips.estimate_offset, [t + 437 for t in true_times], maxdiff=300, positions=anchors, check=offset_found)
+
+        url_cache = gps2name.Urlcache(path=os.path.join(folder, "places.sqlite"))
+        for n in range(places):
+            lat, lon = rnd.uniform(-60, 70), rnd.uniform(-180, 180)
+            url_cache.add_to_gps_cache(lat, lon, {
+                "lat": lat, "lon": lon, "display_name": "place {}".format(n), "cached": "", "used": [],
+                "boundingbox": [lat - 0.01, lat + 0.01, lon - 0.01, lon + 0.01]})
+        #end for
+        queries = [(rnd.uniform(-60, 70), rnd.uniform(-180, 180)) for n in range(10000)]
+        timer.run("place_lookup", len(queries), lambda: [url_cache.get_from_bb_cache(lat, lon) for lat, lon in queries])
+
+        server, url = stub_nominatim()
+        gps2name.rate_limit.interval = 0
+        matched = [r[0] for r in results if r is not None and r[0] is not None][:200]
+        def geocode():
+            geocoder = gps2name.Geocoder(url_cache, url=url)
+            for point in matched:
+                geocoder.submit(point.lat, point.lon, "bench")
+            #end for
+            names = [geocoder.get(point.lat, point.lon, "bench") for point in matched]
+            geocoder.close()
+            return names
+        #end def
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            timer.run("geocode", len(matched), geocode,
+                check=lambda names: "{} of {} places not resolved".format(names.count(None), len(names)) if None in names else None)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        #end try
+        server.shutdown()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    #end try
+    return timer.results
+#end def
+
+def compare(results, baseline, tolerance):
+    regressions = 0
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        #end if
+        ratio = result["seconds"] / max(baseline[stage]["seconds"], 1e-9)
+        flag = ""
+        if ratio > tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        #end if
+        print("{:16s} {:10.4f}s baseline {:10.4f}s  x{:.2f}{}".format(stage, result["seconds"], baseline[stage]["seconds"], ratio, flag))
+    #end for
+    return regressions
+#end def
+
+def main(args):
+    options = {
+        "points": "100000",
+        "devices": "3",
+        "images": "2000",
+        "places": "20000",
+        "tags": "atemp,hr",
+        "tolerance": "1.3",
+    }
+    for arg in args:
+        if "=" not in arg:
+            print("usage: python3 benchmark.py [points=<n>] [devices=<n>] [images=<n>] [tags=<tag,tag>] [places=<n>] [output=<json file>] [baseline=<json file>] [tolerance=<factor>]")
+            return 2
+        #end if
+        key, val = arg.split("=", 1)
+        options[key] = val
+    #end for
+    logging.basicConfig(level=logging.CRITICAL)
+    try:
+        results = run(options)
+    except BenchmarkError as e:
+        print("benchmark failed: {}".format(e))
+        return 2
+    #end try
+    report = {"options": options, "results": results}
+    if "output" in options:
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=1)
+        #end with
+    #end if
+    if "baseline" in options:
+        with open(options["baseline"]) as f:
+            baseline = json.load(f)["results"]
+        #end with
+        if compare(results, baseline, float(options["tolerance"])) > 0:
+            return 1
+        #end if
+    #end if
+    return 0
+#end def
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+#end if
@@ -0,0 +1,122 @@
+#===============================================================================
+# Catalog of gpx files for gpxcorrelate. For every gpx file it stores size,
+# mtime and the time of the first and last track point in a SQLite database in
+# ~/.cache/gpxcorrelate/catalog.sqlite. Files that changed since they were
+# cataloged are scanned once for the earliest and latest <time> inside a
+# <trkpt>, without building the track. Files whose times cannot be read get
+# no span and are always loaded.
+#===============================================================================
+import os
+import re
+import time
+import sqlite3
+import logging
+import stats
+
+TRKPT_BLOCK = re.compile(rb"<(?:\w+:)?trkpt\b(.*?)</(?:\w+:)?trkpt>", re.S)
+TRKPT_END = re.compile(rb">tpkrt(?::\w+)?/<")
+TIME = re.compile(rb"<(?:\w+:)?time>\s*([^<\s]+)\s*</(?:\w+:)?time>")
+CHUNK = 65536
+# spans cataloged by older versions came from the head and tail of the file
+# only and are discarded
+VERSION = 1
+
+class Catalog:
+    # parse_time: function gpx timestamp string -> epoch seconds
+    def __init__(self, parse_time, path=None):
+        if path is None:
+            path = os.path.join(os.environ["HOME"], ".cache", "gpxcorrelate", "catalog.sqlite")
+        #end if
+        self.path = path
+        self.parse_time = parse_time
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+            first INTEGER, last INTEGER, cataloged REAL)""")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != VERSION:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("PRAGMA user_version = {}".format(VERSION))
+        #end if
+        self.hits = 0
+        self.misses = 0
+    #end def
+
+    # Earliest and latest track point time of the file. Track points are not
+    # assumed to be in time order (merged or concatenated exports), so every
+    # <trkpt> is scanned, in chunks that end at a closing </trkpt>.
+    def time_span(self, f):
+        first = last = None
+        rest = b""
+        while True:
+            chunk = f.read(CHUNK)
+            data = rest + chunk
+            if chunk:
+                end = TRKPT_END.search(data[::-1])
+                if end is None:
+                    rest = data
+                    continue
+                #end if
+                cut = len(data) - end.start()
+                data, rest = data[:cut], data[cut:]
+            #end if
+            for trkpt in TRKPT_BLOCK.finditer(data):
+                match = TIME.search(trkpt.group(1))
+                if match is None:
+                    continue
+                #end if
+                t = self.parse_time(match.group(1).decode("ascii"))
+                if first is None or t < first:
+                    first = t
+                #end if
+                if last is None or t > last:
+                    last = t
+                #end if
+            #end for
+            if not chunk:
+                return first, last
+            #end if
+        #end while
+    #end def
+
+    # Returns a dict gpxfile -> (first, last) track point time, or None for
+    # files without a known span. Unchanged files are not read at all.
+    @stats.timed("catalog")
+    def spans(self, gpxfiles):
+        spans = {}
+        updates = []
+        for gpxfile in gpxfiles:
+            path = os.path.abspath(gpxfile)
+            try:
+                st = os.stat(gpxfile)
+            except OSError:
+                spans[gpxfile] = None
+                continue
+            #end try
+            row = self.db.execute("SELECT size, mtime, first, last FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and tuple(row[:2]) == (st.st_size, st.st_mtime_ns):
+                self.hits += 1
+                spans[gpxfile] = None if row[2] is None else (row[2], row[3])
+                continue
+            #end if
+            self.misses += 1
+            try:
+                with open(gpxfile, "rb") as f:
+                    first, last = self.time_span(f)
+                #end with
+            except (OSError, ValueError, IndexError, KeyError) as e:
+                logging.warn("{}: cannot catalog ({}).".format(gpxfile, e))
+                first = last = None
+            #end try
+            spans[gpxfile] = None if first is None else (first, last)
+            updates.append((path, st.st_size, st.st_mtime_ns, first, last, time.time()))
+        #end for
+        if updates:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", updates)
+            self.db.execute("COMMIT")
+        #end if
+        return spans
+    #end def
+#end class
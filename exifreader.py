@@ -0,0 +1,198 @@
+#===============================================================================
+# A minimal in-process EXIF reader for gpxcorrelate. Instead of spawning
+# "exiv2 -pv" for every image, the file is memory-mapped and only the TIFF
+# IFDs needed for correlation are walked: IFD0, the Exif IFD and the GPS IFD.
+# Supported containers are JPEG (APP1 "Exif" segment) and TIFF based files,
+# which covers most RAW formats (DNG, CR2, NEF, ARW, PEF, ORF, RW2, ...).
+# Values are returned as strings in the same format as "exiv2 -pv", so the
+# result can be used in place of gpxcorrelate.get_exiv2().
+#===============================================================================
+import mmap
+import struct
+
+IFD_TAGS = {
+    "IFD0": {
+        0x0132: "DateTime",
+        0x8769: "ExifTag",
+        0x8825: "GPSTag",
+    },
+    "Exif": {
+        0x9003: "DateTimeOriginal",
+        0x9004: "DateTimeDigitized",
+        0x9286: "UserComment",
+    },
+    "GPS": {
+        0x0001: "GPSLatitudeRef",
+        0x0002: "GPSLatitude",
+        0x0003: "GPSLongitudeRef",
+        0x0004: "GPSLongitude",
+        0x0005: "GPSAltitudeRef",
+        0x0006: "GPSAltitude",
+    },
+}
+
+DEFAULT_TAGS = set(IFD_TAGS["Exif"].values()) | set(IFD_TAGS["GPS"].values())
+
+# TIFF field type: (struct format, size)
+TYPES = {
+    1: ("B", 1),    # BYTE
+    2: ("s", 1),    # ASCII
+    3: ("H", 2),    # SHORT
+    4: ("L", 4),    # LONG
+    5: ("LL", 8),   # RATIONAL
+    6: ("b", 1),    # SBYTE
+    7: ("s", 1),    # UNDEFINED
+    8: ("h", 2),    # SSHORT
+    9: ("l", 4),    # SLONG
+    10: ("ll", 8),  # SRATIONAL
+}
+
+TIFF_MAGIC = (b"II*\x00", b"MM\x00*", b"IIRO", b"IIRS", b"IIU\x00")
+
+class ExifError(Exception):
+    pass
+#end class
+
+def decode_comment(raw):
+    charset, text = raw[:8], raw[8:]
+    if charset.startswith(b"UNICODE"):
+        try: return text.decode("utf-16").rstrip("\x00 ")
+        except: pass
+    #end if
+    return text.decode("utf-8", "replace").rstrip("\x00 ")
+#end def
+
+class TiffReader:
+    def __init__(self, buf, base):
+        self.buf = buf
+        self.base = base
+        order = buf[base:base+2]
+        if order == b"II": self.endian = "<"
+        elif order == b"MM": self.endian = ">"
+        else: raise ExifError("no tiff header")
+    #end def
+
+    def unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        offset += self.base
+        if offset < 0 or offset + struct.calcsize(fmt) > len(self.buf):
+            raise ExifError("offset out of range")
+        #end if
+        return struct.unpack_from(fmt, self.buf, offset)
+    #end def
+
+    def value(self, ftype, count, field):
+        fmt, size = TYPES[ftype]
+        length = size * count
+        if length <= 4:
+            offset = field
+        else:
+            offset = self.base + self.unpack("L", field - self.base)[0]
+        #end if
+        if offset < 0 or offset + length > len(self.buf):
+            raise ExifError("value out of range")
+        #end if
+        raw = bytes(self.buf[offset:offset+length])
+        if ftype == 2:
+            return raw.split(b"\x00", 1)[0].decode("latin-1").strip()
+        if ftype == 7:
+            return raw
+        values = struct.unpack(self.endian + fmt[0] * (count * len(fmt)), raw)
+        if len(fmt) == 2:
+            return " ".join("{}/{}".format(values[i], values[i+1]) for i in range(0, len(values), 2))
+        #end if
+        return " ".join(str(v) for v in values)
+    #end def
+
+    def ifd(self, offset, names, wanted, result):
+        count = self.unpack("H", offset)[0]
+        pointers = {}
+        for i in range(count):
+            entry = offset + 2 + 12 * i
+            tag, ftype, n = self.unpack("HHL", entry)
+            name = names.get(tag)
+            if name is None or ftype not in TYPES:
+                continue
+            #end if
+            if name in ("ExifTag", "GPSTag"):
+                pointers[name] = self.unpack("L", entry + 8)[0]
+                continue
+            #end if
+            if wanted is not None and name not in wanted:
+                continue
+            #end if
+            value = self.value(ftype, n, self.base + entry + 8)
+            if name == "UserComment":
+                value = decode_comment(value)
+            elif isinstance(value, bytes):
+                value = " ".join(str(b) for b in value)
+            #end if
+            result[name] = value
+        #end for
+        return pointers
+    #end def
+
+    def read(self, wanted=None):
+        result = {}
+        first = self.unpack("L", 4)[0]
+        pointers = self.ifd(first, IFD_TAGS["IFD0"], wanted, result)
+        if "ExifTag" in pointers:
+            self.ifd(pointers["ExifTag"], IFD_TAGS["Exif"], wanted, result)
+        #end if
+        if "GPSTag" in pointers:
+            self.ifd(pointers["GPSTag"], IFD_TAGS["GPS"], wanted, result)
+        #end if
+        return result
+    #end def
+#end class
+
+def find_jpeg_exif(buf):
+    pos = 2
+    while pos + 4 <= len(buf):
+        if buf[pos] != 0xFF:
+            raise ExifError("corrupt jpeg marker")
+        #end if
+        marker = buf[pos+1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        #end if
+        if marker in (0xD9, 0xDA):
+            break
+        #end if
+        length = struct.unpack_from(">H", buf, pos + 2)[0]
+        if marker == 0xE1 and buf[pos+4:pos+10] == b"Exif\x00\x00":
+            return pos + 10
+        #end if
+        pos += 2 + length
+    #end while
+    return None
+#end def
+
+# Returns a dict of tag name -> value string, an empty dict for a supported
+# file without EXIF data and None if the file format is not supported.
+def read_exif(path, wanted=DEFAULT_TAGS):
+    try:
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    #end try
+    try:
+        if buf[:2] == b"\xff\xd8":
+            base = find_jpeg_exif(buf)
+            if base is None:
+                return {}
+            #end if
+        elif buf[:4] in TIFF_MAGIC:
+            base = 0
+        else:
+            return None
+        #end if
+        return TiffReader(buf, base).read(wanted)
+    except (ExifError, struct.error, KeyError, IndexError):
+        return None
+    finally:
+        buf.close()
+    #end try
+#end def
@@ -0,0 +1,232 @@
+#===============================================================================
+# Offline reverse geocoding for gpxcorrelate from a local GeoNames dump, e.g.
+# cities500.txt or allCountries.txt from https://download.geonames.org/export/dump/
+# The dump is converted once into a compact index file: the places as unit
+# vectors in an implicit k-d tree (median split, tree order stored as flat
+# float64 arrays), followed by the place names. The index is memory-mapped,
+# so opening it costs nothing and a lookup only touches the tree nodes it
+# visits. If admin1CodesASCII.txt and countryInfo.txt are found next to the
+# dump, names are built like Nominatim's display_name: "place, region, country".
+#
+# usage: python3 gazetteer.py <geonames dump> [<index file>]
+#===============================================================================
+import os
+import sys
+import math
+import mmap
+import array
+import struct
+import logging
+import stats
+
+MAGIC = b"GAZ1"
+HEADER = struct.Struct("<4sII")
+
+def unit_vector(lat, lon):
+    phi = math.radians(lat)
+    lam = math.radians(lon)
+    return (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi))
+#end def
+
+def read_names(path, key_column, name_column):
+    names = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                #end if
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) > max(key_column, name_column):
+                    names[fields[key_column]] = fields[name_column]
+                #end if
+            #end for
+        #end with
+    except OSError:
+        pass
+    #end try
+    return names
+#end def
+
+def read_dump(dumpfile, classes="P"):
+    folder = os.path.dirname(dumpfile)
+    admin1 = read_names(os.path.join(folder, "admin1CodesASCII.txt"), 0, 1)
+    countries = read_names(os.path.join(folder, "countryInfo.txt"), 0, 4)
+    places = []
+    with open(dumpfile, "r", encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 11 or (classes and fields[6] not in classes):
+                continue
+            #end if
+            try:
+                lat = float(fields[4])
+                lon = float(fields[5])
+            except ValueError:
+                continue
+            #end try
+            parts = [fields[1]]
+            region = admin1.get("{}.{}".format(fields[8], fields[10]))
+            if region and region != fields[1]:
+                parts.append(region)
+            #end if
+            parts.append(countries.get(fields[8], fields[8]))
+            places.append(unit_vector(lat, lon) + (", ".join(p for p in parts if p),))
+        #end for
+    #end with
+    return places
+#end def
+
+# Reorders the places so that the median of every range [lo, hi) along the
+# axis of its depth sits at (lo + hi) // 2.
+def build_tree(places):
+    stack = [(0, len(places), 0)]
+    while stack:
+        lo, hi, depth = stack.pop()
+        if hi - lo <= 1:
+            continue
+        #end if
+        axis = depth % 3
+        places[lo:hi] = sorted(places[lo:hi], key=lambda p: p[axis])
+        mid = (lo + hi) // 2
+        stack.append((lo, mid, depth + 1))
+        stack.append((mid + 1, hi, depth + 1))
+    #end while
+    return places
+#end def
+
+def build_index(dumpfile, indexfile, classes="P"):
+    places = build_tree(read_dump(dumpfile, classes))
+    names = array.array("I", [0])
+    blob = bytearray()
+    for p in places:
+        blob += p[3].encode("utf-8")
+        names.append(len(blob))
+    #end for
+    tmpfile = "{}.{}.tmp".format(indexfile, os.getpid())
+    with open(tmpfile, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(places), len(blob)))
+        f.write(b"\0" * 4)
+        for axis in range(3):
+            f.write(array.array("d", [p[axis] for p in places]).tobytes())
+        #end for
+        f.write(names.tobytes())
+        f.write(bytes(blob))
+    #end with
+    os.replace(tmpfile, indexfile)
+    logging.info("{}: {} places indexed in {}".format(dumpfile, len(places), indexfile))
+#end def
+
+class Gazetteer:
+    # path is either an index file or a GeoNames dump; for a dump the index
+    # <dump>.idx is (re)built when it is missing or older than the dump.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+        #end with
+        if magic != MAGIC:
+            indexfile = path + ".idx"
+            if not os.path.exists(indexfile) or os.path.getmtime(indexfile) < os.path.getmtime(path):
+                build_index(path, indexfile)
+            #end if
+            path = indexfile
+        #end if
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        #end with
+        magic, self.n, blob_len = HEADER.unpack_from(self.buf, 0)
+        view = memoryview(self.buf)
+        offset = HEADER.size + 4
+        self.axes = []
+        for axis in range(3):
+            self.axes.append(view[offset:offset + 8 * self.n].cast("d"))
+            offset += 8 * self.n
+        #end for
+        self.offsets = view[offset:offset + 4 * (self.n + 1)].cast("I")
+        offset += 4 * (self.n + 1)
+        self.names = view[offset:offset + blob_len]
+    #end def
+
+    def __len__(self):
+        return self.n
+    #end def
+
+    def name(self, i):
+        return bytes(self.names[self.offsets[i]:self.offsets[i+1]]).decode("utf-8")
+    #end def
+
+    # Returns (display name, distance in km) of the closest place, or None.
+    @stats.timed("gazetteer")
+    def nearest(self, lat, lon):
+        q = unit_vector(lat, lon)
+        xs, ys, zs = self.axes
+        best = -1
+        best_d = float("inf")
+        stack = [(0, self.n, 0, 0.0)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if lo >= hi or bound >= best_d:
+                continue
+            #end if
+            mid = (lo + hi) // 2
+            p = (xs[mid], ys[mid], zs[mid])
+            d = (p[0] - q[0])**2 + (p[1] - q[1])**2 + (p[2] - q[2])**2
+            if d < best_d:
+                best, best_d = mid, d
+            #end if
+            diff = q[depth % 3] - p[depth % 3]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            #end if
+            stack.append(far + (depth + 1, diff * diff))
+            stack.append(near + (depth + 1, 0.0))
+        #end while
+        if best < 0:
+            return None
+        #end if
+        km = 2 * 6371.0 * math.asin(min(1.0, math.sqrt(best_d) / 2))
+        return self.name(best), km
+    #end def
+#end class
+
+#===============================================================================
+# Same interface as gps2name.Geocoder, for place=offline.
+#===============================================================================
+class OfflineGeocoder:
+    def __init__(self, path):
+        self.gazetteer = Gazetteer(path)
+        self.places = {}
+    #end def
+
+    def submit(self, lat, lon, image):
+        pass
+    #end def
+
+    def get(self, lat, lon, image):
+        key = "{:.4f}:{:.4f}".format(lat, lon)
+        if key not in self.places:
+            result = self.gazetteer.nearest(lat, lon)
+            self.places[key] = None if result is None else result[0]
+        #end if
+        name = self.places[key]
+        if name is not None:
+            print('[offline] {}: {}'.format(image, name))
+        #end if
+        return name
+    #end def
+
+    def close(self):
+        pass
+    #end def
+#end class
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) < 2:
+        print("usage: python3 gazetteer.py <geonames dump> [<index file>]")
+        sys.exit(1)
+    #end if
+    build_index(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else sys.argv[1] + ".idx")
+#end if
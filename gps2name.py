@@ -5,141 +5,363 @@
 # Especially, do NOT use this script for geolocating large collections of
 # photos. According to [1], a couple of 100s of holiday photos once or
 # twice a year should be OK.
-# I implemented a caching algorithm as required. After each cache miss and
-# subsequent Nominatim call, the script sleeps for 2 seconds.
+# I implemented a caching algorithm as required. Nominatim calls are at least
+# 2 seconds apart and share one HTTP session. The cache is
+# kept in ~/.cache/nominatim_urls.sqlite.
 #===============================================================================
 import os
 import datetime
 import json
 import time
 import logging
-import requests
+import sqlite3
+import threading
+import queue
+import stats
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+#===============================================================================
+# The place cache is a SQLite database in WAL mode, so inserts are cheap,
+# lookups only read the rows they need and several runs can use the cache at
+# the same time. An old json cache (nominatim_urls.json) is imported on first
+# use and renamed to nominatim_urls.json.migrated.
+#===============================================================================
 class Urlcache:
-    def __init__(self):
-        self.cache = os.path.join(os.environ["HOME"], ".cache", "nominatim_urls.json")
-        self.gps_cache = {}
-        self.bb_cache = {}
+    def __init__(self, path=None):
+        cachedir = os.path.join(os.environ["HOME"], ".cache")
+        self.cache = path or os.path.join(cachedir, "nominatim_urls.sqlite")
+        self.enabled = True
+        try:
+            self.db = sqlite3.connect(self.cache, timeout=30, isolation_level=None, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.Error:
+            logging.warn("could not open {}. Caching disabled.".format(self.cache))
+            self.enabled = False
+            self.db = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+        #end try
+        self.lock = threading.Lock()
+        self.db.execute("""CREATE TABLE IF NOT EXISTS places (
+            gps_key TEXT PRIMARY KEY, bb_key TEXT, data TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS places_bb ON places (bb_key)")
         try:
-            open(self.cache,'r').close()
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS places_box USING rtree(id, lat1, lat2, lon1, lon2)")
+        except sqlite3.OperationalError:
+            # sqlite without the rtree module: plain table with a range index
+            self.db.execute("CREATE TABLE IF NOT EXISTS places_box (id INTEGER PRIMARY KEY, lat1 REAL, lat2 REAL, lon1 REAL, lon2 REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS places_box_lat ON places_box (lat1, lat2)")
+        #end try
+        self.stats = {"gps_hit": 0, "gps_miss": 0, "bb_hit": 0, "bb_miss": 0}
+        if path is None:
+            self.migrate(os.path.join(cachedir, "nominatim_urls.json"))
+        #end if
+        self.build_bb_index()
+    #end def
+
+    # A place matches a position if the position lies within the inner half
+    # of the place's bounding box, so the inner box is what gets indexed.
+    def inner_box(self, data):
+        try:
+            lat1, lat2, lon1, lon2 = [float(s) for s in data["boundingbox"]]
         except:
-            try:
-                open(self.cache,'w').close()
-            except:
-                logger.warn("could not open {}. Caching disabled.".format(self.cache))
-                self.enabled = False
-            #end try
+            return None
+        #end try
+        return (lat1 + (lat2 - lat1) * 0.25, lat1 + (lat2 - lat1) * 0.75,
+                lon1 + (lon2 - lon1) * 0.25, lon1 + (lon2 - lon1) * 0.75)
+    #end def
+
+    # indexes places added by older versions or by a json migration
+    def build_bb_index(self):
+        with self.lock:
+            last = self.db.execute("SELECT max(id) FROM places_box").fetchone()[0] or 0
+            rows = self.db.execute("SELECT rowid, data FROM places WHERE rowid > ?", (last,)).fetchall()
+            if not rows:
+                return
+            #end if
+            self.db.execute("BEGIN IMMEDIATE")
+            for rowid, data in rows:
+                box = self.inner_box(json.loads(data))
+                if box is not None:
+                    self.db.execute("INSERT OR REPLACE INTO places_box VALUES (?, ?, ?, ?, ?)", (rowid,) + box)
+                #end if
+            #end for
+            self.db.execute("COMMIT")
+        #end with
+        logging.info("{}: {} places added to the bounding box index".format(self.cache, len(rows)))
+    #end def
+
+    def migrate(self, jsonfile):
+        try:
+            with open(jsonfile, 'r') as f:
+                gps_cache = json.load(f)
+            #end with
+        except:
+            return
+        #end try
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            for gps_key, data in gps_cache.items():
+                self.db.execute("INSERT OR IGNORE INTO places VALUES (?, ?, ?)",
+                    (gps_key, self.bb_key(data, gps_key), json.dumps(data)))
+            #end for
+            self.db.execute("COMMIT")
+        #end with
+        try:
+            os.rename(jsonfile, jsonfile + ".migrated")
+        except OSError:
+            pass
         #end try
+        logging.info("migrated {} places from {} to {}".format(len(gps_cache), jsonfile, self.cache))
+    #end def
+
+    def bb_key(self, data, gps_key):
         try:
-            f = open(self.cache, 'r')
-            self.gps_cache = json.load(f)
-            f.close()
+            return "{:.2f}:{:.2f}".format(float(data['lat']), float(data['lon']))
         except:
-            self.gps_cache = {}
+            lat, lon = [float(s) for s in gps_key.split(":")]
+            return "{:.2f}:{:.2f}".format(lat, lon)
         #end try
-        self.build_bb_cache()
     #end def
-    
+
+    # entries are written immediately, save() is kept for compatibility
     def save(self):
-        with open(self.cache, "w") as f:
-            json.dump(self.gps_cache, f, indent=0)
-        #end with
-    
+        pass
+    #end def
+
+    # the bounding box index is maintained by add_to_gps_cache
     def add_to_bb_cache(self, lat, lon):
-        bb_key = "{:.2f}:{:.2f}".format(lat, lon)
-        gps_key = "{:.4f}:{:.4f}".format(lat, lon)
-        if not gps_key in self.bb_cache.get(bb_key, []): 
-            try:
-                self.bb_cache[bb_key].append(gps_key)
-            except:
-                self.bb_cache[bb_key] = [gps_key,]
-            #end try
-        #end if
+        pass
     #end def
-    
+
+    @stats.timed("urlcache_add")
     def add_to_gps_cache(self, lat, lon, data):
         gps_key = "{:.4f}:{:.4f}".format(lat, lon)
-        self.gps_cache[gps_key] = data
+        box = self.inner_box(data)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            row = self.db.execute("SELECT rowid FROM places WHERE gps_key = ?", (gps_key,)).fetchone()
+            if row is None:
+                rowid = self.db.execute("INSERT INTO places VALUES (?, ?, ?)",
+                    (gps_key, self.bb_key(data, gps_key), json.dumps(data))).lastrowid
+            else:
+                rowid = row[0]
+                self.db.execute("UPDATE places SET bb_key = ?, data = ? WHERE rowid = ?",
+                    (self.bb_key(data, gps_key), json.dumps(data), rowid))
+                self.db.execute("DELETE FROM places_box WHERE id = ?", (rowid,))
+            #end if
+            if box is not None:
+                self.db.execute("INSERT INTO places_box VALUES (?, ?, ?, ?, ?)", (rowid,) + box)
+            #end if
+            self.db.execute("COMMIT")
+        #end with
     #end def
-        
-    def build_bb_cache(self):
-        for key in self.gps_cache:
-            data = self.gps_cache[key]
-            bb_key = "{:.2f}:{:.2f}".format(float(data['lat']), float(data['lon']))
-            try:
-                self.bb_cache[bb_key].append(key)
-            except:
-                self.bb_cache[bb_key] = [key,]
-            #end try
-        #end for
+
+    def mark_used(self, lat, lon, data, image):
+        if image in data['used']:
+            return
+        #end if
+        data['used'].append(image)
+        gps_key = "{:.4f}:{:.4f}".format(lat, lon)
+        with self.lock:
+            self.db.execute("UPDATE places SET data = ? WHERE gps_key = ?", (json.dumps(data), gps_key))
+        #end with
     #end def
 
+    @stats.timed("urlcache_gps")
     def get_from_gps_cache(self, lat, lon):
         gps_key = "{:.4f}:{:.4f}".format(lat, lon)
-        try:
-            return self.gps_cache[gps_key]
-        except:
+        with self.lock:
+            row = self.db.execute("SELECT data FROM places WHERE gps_key = ?", (gps_key,)).fetchone()
+        #end with
+        if row is None:
+            self.stats["gps_miss"] += 1
             return None
-        #end try
+        #end if
+        self.stats["gps_hit"] += 1
+        return json.loads(row[0])
     #end def
 
+    # Returns the most specific cached place (smallest bounding box) whose
+    # inner bounding box contains the position.
+    @stats.timed("urlcache_bb")
     def get_from_bb_cache(self, lat, lon):
-        
-        bb_key = "{:.2f}:{:.2f}".format(lat, lon)
-        try:
-            bb_list = self.bb_cache[bb_key]
-        except:
+        with self.lock:
+            row = self.db.execute("""SELECT p.data FROM places_box b JOIN places p ON p.rowid = b.id
+                WHERE b.lat1 <= ? AND b.lat2 >= ? AND b.lon1 <= ? AND b.lon2 >= ?
+                ORDER BY (b.lat2 - b.lat1) * (b.lon2 - b.lon1) LIMIT 1""", (lat, lat, lon, lon)).fetchone()
+        #end with
+        if row is None:
+            self.stats["bb_miss"] += 1
             return None
-        #end try
-        for gps_key in bb_list:
-            data = self.gps_cache[gps_key]
-            lat1, lat2, lon1, lon2 = [float(s) for s in data["boundingbox"]]
-            lat1a = lat1 + (lat2 - lat1) * 0.25
-            lat2a = lat1 + (lat2 - lat1) * 0.75
-            lon1a = lon1 + (lon2 - lon1) * 0.25
-            lon2a = lon1 + (lon2 - lon1) * 0.75
-            print(lat, lon, data["boundingbox"], lat1, lat2, lon1, lon2, lat1 <= lat, lat2 >= lat, lon1 <= lon, lon2 >= lon)
-            if lat1a <= lat and lat2a >= lat and lon1a <= lon and lon2a >= lon:
-                return data
+        #end if
+        self.stats["bb_hit"] += 1
+        return json.loads(row[0])
+    #end def
+#end class
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/reverse"
+NOMINATIM_INTERVAL = 2.0
+USER_AGENT = "gpxcorrelate (https://github.com/git47/gpxcorrelate)"
+
+#===============================================================================
+# All Nominatim requests share one HTTP session (connection reuse) and one rate
+# limiter, which makes sure that at least NOMINATIM_INTERVAL seconds pass
+# between two requests instead of sleeping after each of them. requests is
+# imported with the first session, so using the cache alone does not load it.
+#===============================================================================
+class RateLimit:
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = None
+        self.lock = threading.Lock()
+    #end def
+
+    @stats.timed("nominatim_wait")
+    def wait(self):
+        with self.lock:
+            if self.last is not None:
+                delay = self.last + self.interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                #end if
             #end if
-        #end for
-        return None
+            self.last = time.monotonic()
+        #end with
     #end def
 #end class
 
-def get_from_nominatim(lat, lon):        
-    url="https://nominatim.openstreetmap.org/reverse?format=jsonv2&lat={}&lon={}".format(lat, lon)
-    response = requests.get(url.format(lat, lon))
-    time.sleep(2)
-    #text = response.read()
+rate_limit = RateLimit(NOMINATIM_INTERVAL)
+session = None
+
+def get_session():
+    global session
+    if session is None:
+        session = stats.load("requests").Session()
+        session.headers["User-Agent"] = USER_AGENT
+    #end if
+    return session
+#end def
+
+@stats.timed("nominatim")
+def get_from_nominatim(lat, lon, url=None):
+    rate_limit.wait()
+    response = get_session().get(url or NOMINATIM_URL, params={"format": "jsonv2", "lat": lat, "lon": lon}, timeout=30)
+    response.raise_for_status()
     text = response.content
     return json.loads(str(text, 'utf-8'))
 #end def
-    
-def gps2name(lat, lon, image, url_cache):
+
+# Returns (name, status, place data) for a position, using the cache first.
+# bbox: also accept a cached place whose bounding box contains the position
+# instead of asking Nominatim; large places (parks, counties) then name
+# everything inside them, so this is off unless place=bbox asks for it.
+@stats.timed("gps2name")
+def lookup(lat, lon, image, url_cache, url=None, bbox=False):
     # try exact cache hits first
     place_data = url_cache.get_from_gps_cache(lat, lon)
     if place_data is not None:
-        if not image in place_data['used']:
-            place_data['used'].append(image)
-        #end if
-#         n_data = get_from_nominatim(lat, lon)
-#         if n_data["place_id"] != place_data["place_id"]:
-#             print ("\n{}:\n{}\n{}\n\n".format(image, n_data["display_name"], place_data["display_name"]))
-#         #end if
-        print('[cached: {} used: {}] {}: {}'.format(place_data['cached'], len(place_data['used']), image, place_data['display_name']))
-        return place_data['display_name']
+        url_cache.mark_used(lat, lon, place_data, image)
+        status = 'cached: {} used: {}'.format(place_data['cached'], len(place_data['used']))
+        return place_data['display_name'], status, place_data
     #end if
-    place_data = get_from_nominatim(lat, lon)
+    # then places whose bounding box contains the position
+    place_data = url_cache.get_from_bb_cache(lat, lon) if bbox else None
+    if place_data is not None:
+        status = 'cached: {} bounding box'.format(place_data['cached'])
+        return place_data['display_name'], status, None
+    #end if
+    place_data = get_from_nominatim(lat, lon, url)
     place_data['cached'] = datetime.date.isoformat(datetime.datetime.now())
     place_data['used'] = [image]
-    #name = place_data['results'][0]['formatted_address']
     name = place_data['display_name']
-    print('[nominatim] {}: {}'.format(image, name))
     url_cache.add_to_gps_cache(lat, lon, place_data)
-    url_cache.add_to_bb_cache(lat, lon)
-    url_cache.save()
+    return name, 'nominatim', place_data
+#end def
+
+def gps2name(lat, lon, image, url_cache):
+    name, status, place_data = lookup(lat, lon, image, url_cache)
+    print('[{}] {}: {}'.format(status, image, name))
     return name
 #end def
 
+#===============================================================================
+# Geocoding queue. Positions are submitted as soon as an image is matched and
+# resolved by a single worker thread, in submission order and at most one
+# Nominatim request per NOMINATIM_INTERVAL. Positions are deduplicated on the
+# cache key (4 decimals), so every distinct position is looked up once. The
+# caller keeps correlating and writing while the worker waits for the network
+# and collects the names with get().
+#===============================================================================
+class Geocoder:
+    def __init__(self, url_cache, url=None, bbox=False):
+        self.url_cache = url_cache
+        self.url = url
+        self.bbox = bbox
+        self.queue = queue.Queue()
+        self.submitted = {}
+        self.done = {}
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="geocoder", daemon=True)
+        self.thread.start()
+    #end def
+
+    def key(self, lat, lon):
+        return "{:.4f}:{:.4f}".format(lat, lon)
+    #end def
+
+    def submit(self, lat, lon, image):
+        key = self.key(lat, lon)
+        with self.cond:
+            if key in self.submitted:
+                return
+            #end if
+            self.submitted[key] = image
+        #end with
+        self.queue.put((key, lat, lon, image))
+    #end def
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            #end if
+            key, lat, lon, image = item
+            try:
+                result = lookup(lat, lon, image, self.url_cache, self.url, self.bbox)
+            except Exception as e:
+                logging.warn("{}: place lookup failed ({})".format(image, e))
+                result = (None, 'failed', None)
+            #end try
+            with self.cond:
+                self.done[key] = result
+                self.cond.notify_all()
+            #end with
+        #end while
+    #end def
+
+    # Waits for the place name of a submitted position, prints it like
+    # gps2name() and returns it.
+    def get(self, lat, lon, image):
+        key = self.key(lat, lon)
+        self.submit(lat, lon, image)
+        with self.cond:
+            while key not in self.done:
+                self.cond.wait()
+            #end while
+            name, status, place_data = self.done[key]
+            first = self.submitted[key]
+        #end with
+        if place_data is not None and image != first:
+            self.url_cache.mark_used(lat, lon, place_data, image)
+        #end if
+        if name is not None:
+            print('[{}] {}: {}'.format(status, image, name))
+        #end if
+        return name
+    #end def
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+    #end def
+#end class
@@ -3,15 +3,34 @@
 # is possible to track information beyond coordinates, e.g. temperature and heart
 # rate, I decided to write my own correlator. 
 #===============================================================================
+import time
+startup = time.perf_counter()
 import xml.etree.ElementTree as ET
 import sys
 import re
 import os
 import subprocess
+import tempfile
+import sqlite3
+import threading
+import concurrent.futures
 import datetime
-import time
+import calendar
+import array
+import bisect
+import math
+import json
+import hashlib
 import logging
-import gps2name
+import exifreader
+import trackcache
+import stats
+import journal
+import watch
+import catalog
+# gps2name (and with it requests) and gazetteer are only imported when a
+# place lookup is requested, see main()
+stats.started("imports", startup)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 if __name__ == "__main__":
@@ -25,10 +44,26 @@ else:
     logger = logging.getLogger(__file__)
 #end if
 
+NAN = float("nan")
+
+# comment format per tag and per tag:aggregate, see tag=
 Tags = {
-    "atemp": ["{value}C",], 
+    "atemp": ["{value:g}C",],
+    "atemp:mean": ["{value:.1f}C",],
+    "atemp:min": ["min {value:g}C",],
+    "atemp:max": ["max {value:g}C",],
+    "wtemp": ["water {value:g}C",],
+    "hr": ["{value:g}bpm",],
+    "hr:mean": ["{value:.0f}bpm",],
+    "hr:min": ["min {value:g}bpm",],
+    "hr:max": ["max {value:g}bpm",],
+    "cad": ["{value:g}rpm",],
+    "cad:mean": ["{value:.0f}rpm",],
+    "cad:max": ["max {value:g}rpm",],
 }
 
+Aggregates = ('mean', 'min', 'max')
+
 Nsp = {
     "gpx": "http://www.topografix.com/GPX/1/1",
     "gpxx" : "http://www.garmin.com/xmlschemas/GpxExtensions/v3",
@@ -38,6 +73,18 @@ Nsp = {
 }
 
 
+GPX_TIME = "{{{}}}time".format(Nsp["gpx"])
+GPX_ELE = "{{{}}}ele".format(Nsp["gpx"])
+
+# smallest confidence of an estimated time offset (to=auto) that is applied
+Auto_offset_confidence = 0.3
+
+# options that change the result for an image, see journal.fingerprint()
+Journal_options = ('tz', 'to', 'tag', 'window', 'simplify', 'comment', 'place', 'interpolate', 'cluster', 'nominatim', 'gazetteer', 'output', 'sidecar', 'torange', 'catalog')
+
+# files in watched image directories that are never treated as images
+Watch_ignore = ('.xmp', '.gpx', '.exv', '.tmp', '.log')
+
 States = {
     "NONE"              : "",
     "GPS_PRESENT"       : "gps present",
@@ -48,6 +95,8 @@ States = {
     "OUT_OF_RANGE"      : "out of range",
     "MULTI"             : "multiple matches",
     "TOO_FAR"           : "too far",
+    "WRITTEN"           : "metadata written",
+    "WRITE_FAILED"      : "metadata write failed",
     }
     
 
@@ -68,37 +117,497 @@ def gpsrational_to_hexatupel(rational):
     seconds = 3600 * (rational - degrees) - 60 * minutes
     return "{:d}/1 {:d}/1 {:d}/100".format(degrees, minutes, int(100*seconds))
 #end def
-def set_exiv_comment(imgfile, comment):
-#    cp = subprocess.run(['exiv2', '-k', '-Mset Exif.Photo.UserComment charset=Ascii {}'.format(comment), imgfile],stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    cp = subprocess.run(['exiv2', '-k', '-Mset Exif.Photo.UserComment {}'.format(comment), imgfile],stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+def exiv_comment_commands(comment):
+    return ['set Exif.Photo.UserComment {}'.format(comment)]
 #end def
 
-def set_exiv_gps(imgfile, lon, lat, alt=None):
-    cmdlon = '-Mset Exif.GPSInfo.GPSLongitude {lon}'
-    cmdlonref =  '-Mset Exif.GPSInfo.GPSLongitudeRef {lonref}'
-    cmdlat = '-Mset Exif.GPSInfo.GPSLatitude {lat}'
-    cmdlatref =  '-Mset Exif.GPSInfo.GPSLatitudeRef {latref}'
-    cmdalt = '-Mset Exif.GPSInfo.GPSAltitude {alt}'
-    cmdaltref = '-Mset Exif.GPSInfo.GPSAltitudeRef {altref}'
-
-    cmd = [
-        'exiv2', 
-        cmdlon.format(lon=gpsrational_to_hexatupel([lon, -lon][lon < 0.0])),
-        cmdlonref.format(lonref=['E','W'][lon < 0.0]),
-        cmdlat.format(lat=gpsrational_to_hexatupel([lat, -lat][lat < 0.0])),
-        cmdlatref.format(latref=['N','S'][lat < 0.0]),
-        cmdalt.format(alt="{:d}/10000".format(int([alt, -alt][alt < 0.0] * 10000.0))),
-        cmdaltref.format(altref=int(alt < 0.0)),
-        imgfile
+def exiv_gps_commands(lon, lat, alt=None):
+    cmds = [
+        'set Exif.GPSInfo.GPSLongitude {}'.format(gpsrational_to_hexatupel([lon, -lon][lon < 0.0])),
+        'set Exif.GPSInfo.GPSLongitudeRef {}'.format(['E','W'][lon < 0.0]),
+        'set Exif.GPSInfo.GPSLatitude {}'.format(gpsrational_to_hexatupel([lat, -lat][lat < 0.0])),
+        'set Exif.GPSInfo.GPSLatitudeRef {}'.format(['N','S'][lat < 0.0]),
     ]
-    cp = subprocess.run(cmd, stdout=subprocess.PIPE)
-    logging.debug(" ".join(cmd))
-    
+    if alt is not None and alt == alt:
+        cmds.append('set Exif.GPSInfo.GPSAltitude {:d}/10000'.format(int([alt, -alt][alt < 0.0] * 10000.0)))
+        cmds.append('set Exif.GPSInfo.GPSAltitudeRef {:d}'.format(int(alt < 0.0)))
+    #end if
+    return cmds
+#end def
+
+#===============================================================================
+# Common interface of the metadata writers: set_gps() and set_comment() collect
+# the changes per image, flush() writes everything collected so far and returns
+# the WRITTEN / WRITE_FAILED result of every image written since the writer was
+# created. Subclasses turn the pending changes into jobs (jobs()) and write one
+# job at a time (_write()); with jobs > 1 the jobs of one flush run in parallel.
+#===============================================================================
+class MetadataWriter:
+    def __init__(self, batch=50, jobs=1):
+        self.batch = max(1, int(batch))
+        self.jobs = max(1, int(jobs))
+        self.pending = {}
+        self.order = []
+        self.results = {}
+        self.lock = threading.Lock()
+    #end def
+
+    def _set(self, image, key, value):
+        with self.lock:
+            if image not in self.pending:
+                self.pending[image] = {}
+                self.order.append(image)
+            #end if
+            self.pending[image][key] = value
+        #end with
+    #end def
+
+    def __len__(self):
+        return len(self.order)
+    #end def
+
+    # Correlation details of an image (time offset, state, place); only kept
+    # by writers that record results instead of writing metadata.
+    def set_info(self, image, **info):
+        pass
+    #end def
+
+    # images: write only these images and keep the other pending changes,
+    # e.g. the GPS data of images whose comment is not built yet
+    @stats.timed("flush")
+    def flush(self, images=None):
+        with self.lock:
+            if images is None:
+                pending, order = self.pending, self.order
+                self.pending = {}
+                self.order = []
+            else:
+                pending = dict((image, self.pending.pop(image)) for image in images if image in self.pending)
+                order = list(pending)
+                self.order = [image for image in self.order if image not in pending]
+            #end if
+        #end with
+        jobs = self.jobs_for(pending, sorted(order))
+        if self.jobs > 1 and len(jobs) > 1:
+            with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+                done = list(pool.map(self._write, jobs))
+        else:
+            done = [self._write(job) for job in jobs]
+        #end if
+        for results in done:
+            for image, result in results:
+                if result == "WRITE_FAILED":
+                    logging.error("{}: could not write metadata.".format(image))
+                #end if
+                self.results[image] = result
+            #end for
+        #end for
+        return self.results
+    #end def
+#end class
+
+#===============================================================================
+# exiv2 writer. GPS and UserComment changes are collected per image and merged
+# into a single exiv2 command file, so every image is written by one exiv2
+# call. exiv2 applies a command file to all files given on the command line
+# and cannot take per-file changes in one call, so only images with identical
+# command sets (e.g. a burst snapped to the same track point, with the same
+# comment) share a call, up to <files_per_call> images; batch= does not apply.
+# A failed call is retried image by image so that every image gets its own
+# WRITTEN / WRITE_FAILED result.
+#===============================================================================
+class ExivWriter(MetadataWriter):
+    files_per_call = 50
+
+    def set_gps(self, image, lon, lat, alt=None):
+        self._set(image, 'gps', exiv_gps_commands(lon, lat, alt))
+    #end def
+
+    def set_comment(self, image, comment):
+        self._set(image, 'comment', exiv_comment_commands(comment))
+    #end def
+
+    @stats.timed("exiv2_write")
+    def _run(self, cmds, images):
+        stats.count("subprocess")
+        with tempfile.NamedTemporaryFile('w', suffix='.exv', delete=False) as f:
+            f.write("\n".join(cmds) + "\n")
+            cmdfile = f.name
+        #end with
+        try:
+            cmd = ['exiv2', '-k', '-m', cmdfile] + images
+            cp = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            return False
+        finally:
+            os.unlink(cmdfile)
+        #end try
+        return cp.returncode == 0
+    #end def
+
+    def jobs_for(self, pending, images):
+        groups = {}
+        for image in images:
+            cmds = tuple(pending[image].get('gps', []) + pending[image].get('comment', []))
+            groups.setdefault(cmds, []).append(image)
+        #end for
+        jobs = []
+        for cmds, images in groups.items():
+            for i in range(0, len(images), self.files_per_call):
+                jobs.append((cmds, images[i:i+self.files_per_call]))
+                logging.debug("exiv2 -k -m <{}> {}".format("; ".join(cmds), " ".join(images[i:i+self.files_per_call])))
+            #end for
+        #end for
+        return jobs
+    #end def
+
+    def _write(self, job):
+        cmds, chunk = job
+        if self._run(cmds, chunk):
+            return [(image, "WRITTEN") for image in chunk]
+        #end if
+        results = []
+        for image in chunk:
+            if len(chunk) > 1 and self._run(cmds, [image]):
+                results.append((image, "WRITTEN"))
+            else:
+                results.append((image, "WRITE_FAILED"))
+            #end if
+        #end for
+        return results
+    #end def
+#end class
+
+#===============================================================================
+# XMP sidecar writer (output=xmp). Instead of rewriting the image, GPS and
+# UserComment go to a sidecar next to it. Tools disagree on its name:
+# Lightroom / Adobe Camera Raw and exiv2 (-eX) use <image without
+# extension>.xmp (sidecar=stem, the default), darktable and digiKam use
+# <image>.xmp, e.g. IMG_1.CR2.xmp (sidecar=full). An existing sidecar is
+# parsed and only the GPS properties and the UserComment are replaced, all
+# other metadata in it is kept. Every sidecar is written to a temporary file
+# and renamed, so a sidecar is never left half written. One job writes up to
+# <batch> sidecars.
+#===============================================================================
+XMP_NS = {
+    "x": "adobe:ns:meta/",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "exif": "http://ns.adobe.com/exif/1.0/",
+}
+for prefix, uri in XMP_NS.items():
+    ET.register_namespace(prefix, uri)
+#end for
+XMP_GPS = ('GPSVersionID', 'GPSLatitude', 'GPSLongitude', 'GPSAltitude', 'GPSAltitudeRef')
+
+def xmp_name(prefix, name):
+    return "{{{}}}{}".format(XMP_NS[prefix], name)
+#end def
+
+# XMP stores coordinates as "DDD,MM.mmmmmmK"
+def xmp_coordinate(value, refs):
+    ref = refs[value < 0.0]
+    value = abs(value)
+    degrees = int(value)
+    return "{:d},{:.6f}{}".format(degrees, 60 * (value - degrees), ref)
+#end def
+
+Sidecar_names = ('stem', 'full')
+
+def xmp_sidecar(image, naming="stem"):
+    if naming == "full":
+        return image + ".xmp"
+    #end if
+    return os.path.splitext(image)[0] + ".xmp"
+#end def
+
+class XmpWriter(MetadataWriter):
+    def __init__(self, batch=50, jobs=1, sidecar="stem"):
+        MetadataWriter.__init__(self, batch, jobs)
+        self.sidecar = sidecar
+    #end def
+
+    def set_gps(self, image, lon, lat, alt=None):
+        props = {
+            'GPSVersionID': "2.2.0.0",
+            'GPSLatitude': xmp_coordinate(lat, "NS"),
+            'GPSLongitude': xmp_coordinate(lon, "EW"),
+        }
+        if alt is not None and alt == alt:
+            props['GPSAltitude'] = "{:d}/10000".format(int(abs(alt) * 10000.0))
+            props['GPSAltitudeRef'] = "{:d}".format(int(alt < 0.0))
+        #end if
+        self._set(image, 'gps', props)
+    #end def
+
+    def set_comment(self, image, comment):
+        self._set(image, 'comment', comment)
+    #end def
+
+    # images sharing a sidecar (e.g. IMG_1.CR2 and IMG_1.JPG with
+    # sidecar=stem) are written
+    # together, so no two jobs touch the same file
+    def jobs_for(self, pending, images):
+        sidecars = {}
+        for image in images:
+            group = sidecars.setdefault(xmp_sidecar(image, self.sidecar), ([], {}))
+            group[0].append(image)
+            group[1].update(pending[image])
+        #end for
+        groups = [(sidecar, images, changes) for sidecar, (images, changes) in sidecars.items()]
+        return [groups[i:i+self.batch] for i in range(0, len(groups), self.batch)]
+    #end def
+
+    def _write(self, job):
+        results = []
+        for sidecar, images, changes in job:
+            try:
+                self.write_sidecar(sidecar, changes)
+                result = "WRITTEN"
+            except (OSError, ET.ParseError) as e:
+                logging.debug("{}: {}".format(sidecar, e))
+                result = "WRITE_FAILED"
+            #end try
+            results.extend((image, result) for image in images)
+        #end for
+        return results
+    #end def
+
+    @stats.timed("xmp_write")
+    def write_sidecar(self, sidecar, changes):
+        root = None
+        if os.path.exists(sidecar):
+            # keep the namespace prefixes of the existing sidecar
+            for event, item in ET.iterparse(sidecar, events=("start-ns", "end")):
+                if event == "start-ns" and item[0] and not re.match(r"ns\d+$", item[0]):
+                    ET.register_namespace(*item)
+                elif event == "end":
+                    root = item
+                #end if
+            #end for
+        #end if
+        if root is None or root.find(xmp_name("rdf", "RDF")) is None:
+            root = ET.Element(xmp_name("x", "xmpmeta"))
+            ET.SubElement(root, xmp_name("rdf", "RDF"))
+        #end if
+        rdf = root.find(xmp_name("rdf", "RDF"))
+        desc = rdf.find(xmp_name("rdf", "Description"))
+        if desc is None:
+            desc = ET.SubElement(rdf, xmp_name("rdf", "Description"), {xmp_name("rdf", "about"): ""})
+        #end if
+        if 'gps' in changes:
+            for name in XMP_GPS:
+                desc.attrib.pop(xmp_name("exif", name), None)
+                for elem in desc.findall(xmp_name("exif", name)):
+                    desc.remove(elem)
+                #end for
+            #end for
+            for name, value in changes['gps'].items():
+                desc.set(xmp_name("exif", name), value)
+            #end for
+        #end if
+        if 'comment' in changes:
+            desc.attrib.pop(xmp_name("exif", "UserComment"), None)
+            for elem in desc.findall(xmp_name("exif", "UserComment")):
+                desc.remove(elem)
+            #end for
+            alt = ET.SubElement(ET.SubElement(desc, xmp_name("exif", "UserComment")), xmp_name("rdf", "Alt"))
+            li = ET.SubElement(alt, xmp_name("rdf", "li"), {"{http://www.w3.org/XML/1998/namespace}lang": "x-default"})
+            li.text = changes['comment']
+        #end if
+        tmpfile = "{}.{}.tmp".format(sidecar, os.getpid())
+        try:
+            with open(tmpfile, "wb") as f:
+                f.write(b'<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>\n')
+                f.write(ET.tostring(root, encoding="utf-8", xml_declaration=False))
+                f.write(b'\n<?xpacket end="w"?>\n')
+            #end with
+            os.replace(tmpfile, sidecar)
+        except OSError:
+            try: os.unlink(tmpfile)
+            except OSError: pass
+            raise
+        #end try
+    #end def
+#end class
+
+#===============================================================================
+# Result writer (results=<file>). Instead of writing metadata it appends one
+# compact json line per image to a result file: image path, position, time
+# offset, states, place and new UserComment. Images without a match get a
+# record with their states and no position, so apply= can tell them from
+# images that were not processed. Result files of several runs, e.g. shards
+# on different machines, are combined and written with apply=.
+#===============================================================================
+class ResultWriter(MetadataWriter):
+    def __init__(self, path, batch=50, jobs=1):
+        MetadataWriter.__init__(self, batch, jobs)
+        self.path = path
+        self.file = open(path, "w")
+    #end def
+
+    def set_gps(self, image, lon, lat, alt=None):
+        self._set(image, 'gps', {'lon': lon, 'lat': lat, 'ele': None if alt is None or alt != alt else alt})
+    #end def
+
+    def set_comment(self, image, comment):
+        self._set(image, 'comment', {'comment': comment})
+    #end def
+
+    def set_info(self, image, **info):
+        self._set(image, 'info', info)
+    #end def
+
+    def jobs_for(self, pending, images):
+        return [[(image, pending[image]) for image in images]] if images else []
+    #end def
+
+    @stats.timed("results_write")
+    def _write(self, job):
+        lines = []
+        for image, changes in job:
+            record = {'image': os.path.abspath(image)}
+            for key in ('gps', 'comment', 'info'):
+                record.update(changes.get(key, {}))
+            #end for
+            lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+        #end for
+        with self.lock:
+            self.file.write("".join(lines))
+            self.file.flush()
+        #end with
+        # only records with metadata to write count as written
+        return [(image, "WRITTEN") for image, changes in job if 'gps' in changes or 'comment' in changes]
+    #end def
+#end class
+
+# Ranks the records of one image from different result files: a record with
+# a position beats one without, then exact and interpolated matches beat
+# snapped ones, single matches beat multiple ones and a smaller time offset
+# wins.
+def result_rank(record):
+    state = record.get('state', [])
+    return ('lon' not in record, "EXACT" not in state and "INTERPOLATED" not in state,
+        "MULTI" in state, record.get('offset', float("inf")))
+#end def
+
+# Reads result files; records of the same image within one file are merged,
+# between files the best one according to result_rank() is kept.
+def read_results(resultfiles):
+    merged = {}
+    for resultfile in resultfiles:
+        records = {}
+        with open(resultfile, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                #end if
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warn("{}: invalid result record - skipped.".format(resultfile))
+                    continue
+                #end try
+                records.setdefault(record['image'], {}).update((k, v) for k, v in record.items() if v is not None)
+            #end for
+        #end with
+        for image, record in records.items():
+            if image not in merged or result_rank(record) < result_rank(merged[image]):
+                merged[image] = record
+            #end if
+        #end for
+    #end for
+    return merged
+#end def
+
+# Writes the merged results with the given writer; returns the states.
+def apply_results(resultfiles, writer):
+    states = {}
+    results = read_results(resultfiles)
+    logging.info("{} images in {} result files.".format(len(results), len(resultfiles)))
+    for image in sorted(results):
+        record = results[image]
+        if 'lon' in record:
+            writer.set_gps(image, record['lon'], record['lat'], record.get('ele'))
+        #end if
+        if 'comment' in record:
+            writer.set_comment(image, record['comment'])
+        #end if
+        states[image] = set(record.get('state', []))
+        if len(writer) >= writer.batch * writer.jobs:
+            writer.flush()
+        #end if
+    #end for
+    flushed = writer.flush()
+    for image in results:
+        if image in flushed:
+            states[image].add(flushed.pop(image))
+        #end if
+    #end for
+    return states
+#end def
+
+# Shard (0 .. shards-1) of an image, from a hash of its absolute path, so
+# every node assigns the same images to the same shard.
+def shard_of(image, shards):
+    digest = hashlib.md5(os.path.abspath(image).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
 #end def
 
+Writers = {
+    "exif": ExivWriter,
+    "xmp": XmpWriter,
+}
+
+#===============================================================================
+# Keeps log output deterministic when images are correlated in a thread pool:
+# records logged by a pool thread are collected per task and handed back to the
+# main thread, which re-emits them in image order.
+#===============================================================================
+class OrderedLog(logging.Filter):
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+    #end def
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        #end if
+        records.append(record)
+        return False
+    #end def
+
+    def run(self, func, *args, **kwargs):
+        self.local.records = records = []
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            self.local.records = None
+        #end try
+        return result, records
+    #end def
+
+    def emit(self, records):
+        root = logging.getLogger()
+        for record in records:
+            root.handle(record)
+        #end for
+    #end def
+#end class
 
+@stats.timed("get_exiv2")
 def get_exiv2(imgfile):
+    exif = exifreader.read_exif(imgfile)
+    if exif is not None:
+        return exif
+    #end if
+    return get_exiv2_subprocess(imgfile)
+#end def
+
+def get_exiv2_subprocess(imgfile):
     exif = {}
+    stats.count("subprocess")
     cp = subprocess.run(["exiv2", "-pv", imgfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
     if cp.returncode == 0:
         exif_stream = cp.stdout.split('\n')
@@ -144,11 +653,51 @@ def gpxtime2datetime(ts):
     return datetime.datetime(*[int(s) for s in ts.split("T")[0].split('-')+ ts.split("T")[1][:-1].split(":")])
 #end def
 
+EPOCH_DAYS = {}
+
+# Fast ISO-8601 parser for gpx timestamps, e.g. 2019-05-01T12:00:00Z,
+# 2019-05-01T12:00:00.250Z or 2019-05-01T14:00:00+02:00. Returns epoch seconds
+# rounded to the nearest second. The day number is cached per date string.
+def gpxtime2epoch(ts):
+    ts = ts.strip()
+    date = ts[:10]
+    days = EPOCH_DAYS.get(date)
+    if days is None:
+        days = EPOCH_DAYS[date] = (datetime.date(int(date[:4]), int(date[5:7]), int(date[8:10])) - datetime.date(1970, 1, 1)).days
+    #end if
+    seconds = days * 86400 + int(ts[11:13]) * 3600 + int(ts[14:16]) * 60 + int(ts[17:19])
+    pos = 19
+    if ts[pos:pos+1] in ('.', ','):
+        pos += 1
+        start = pos
+        while pos < len(ts) and ts[pos].isdigit():
+            pos += 1
+        #end while
+        if ts[start:pos] >= '5':
+            seconds += 1
+        #end if
+    #end if
+    tzd = ts[pos:]
+    if tzd and tzd != 'Z':
+        offset = int(tzd[1:3]) * 3600 + int(tzd[-2:]) * 60
+        if tzd[0] == '+':
+            seconds -= offset
+        else:
+            seconds += offset
+        #end if
+    #end if
+    return seconds
+#end def
+
 def exiftime2datetime(ts):
     rets = re.match("(\d\d\d\d):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)", ts)
     return datetime.datetime(*[int(s) for s in rets.groups()])
 #end def
 
+def datetime2epoch(dt):
+    return calendar.timegm(dt.timetuple())
+#end def
+
 class Point:
     def __init__(self, timestamp, lon, lat, elev, data=None):
         self.timestamp = timestamp
@@ -165,192 +714,1067 @@ class Point:
     #end def
 #end class
 
+# Splits a tag= value like "hr:mean" into ("hr", "mean"); ("hr", None) for
+# the value of the matched track point.
+def parse_tag(spec):
+    name, sep, aggregate = spec.partition(":")
+    return name, aggregate or None
+#end def
+
+#===============================================================================
+# Track points are stored column-wise: epoch seconds in an int64 array, lon,
+# lat, elevation and the values of the requested extension tags in float64
+# arrays (NaN if missing). Point objects are only built for matched points.
+# For windowed aggregates over a tag, prefix sums and counts (mean) and sparse
+# tables (min, max) are built on first use, so every aggregate over a time
+# window costs two bisects and O(1) table lookups.
+#===============================================================================
 class Segment:
-    def __init__(self):
+    def __init__(self, tags=()):
         self.start = None
         self.end = None
-        self.points = []
+        self.times = array.array('q')
+        self.lons = array.array('d')
+        self.lats = array.array('d')
+        self.eles = array.array('d')
+        self.tags = list(tags)
+        self.data = dict((tag, array.array('d')) for tag in self.tags)
+        self.sorted = True
+        self.spline = None
+        self.tables = {}
     #end def
     def __len__(self):
-        return(len(self.points))
+        return(len(self.times))
+    #end def
+    def append(self, timestamp, lon, lat, ele=NAN, data=None):
+        if self.end is not None and timestamp < self.times[-1]:
+            self.sorted = False
+        #end if
+        self.times.append(timestamp)
+        self.lons.append(lon)
+        self.lats.append(lat)
+        self.eles.append(ele)
+        for tag in self.tags:
+            self.data[tag].append(NAN if data is None or data.get(tag) is None else data[tag])
+        #end for
+        if self.start is None or self.start > timestamp:
+            self.start = timestamp
+        #end if
+        if self.end is None or self.end < timestamp:
+            self.end = timestamp
+        #end if
     #end def
     def add_point(self, point):
-        self.points.append(point)
-        if self.start is None or self.start > point.timestamp:
-            self.start = point.timestamp
+        ele = NAN if point.elev is None else float(point.elev)
+        self.append(point.timestamp, float(point.lon), float(point.lat), ele, point.data)
+    #end def
+    def finish(self):
+        if self.sorted: return
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        self.times = array.array('q', [self.times[i] for i in order])
+        self.lons = array.array('d', [self.lons[i] for i in order])
+        self.lats = array.array('d', [self.lats[i] for i in order])
+        self.eles = array.array('d', [self.eles[i] for i in order])
+        for tag in self.tags:
+            self.data[tag] = array.array('d', [self.data[tag][i] for i in order])
+        #end for
+        self.sorted = True
+        self.spline = None
+        self.tables = {}
+    #end def
+    def set_columns(self, times, lons, lats, eles, data=None):
+        self.times, self.lons, self.lats, self.eles = times, lons, lats, eles
+        if data is not None:
+            self.data = data
+        #end if
+        self.start = times[0] if len(times) else None
+        self.end = times[-1] if len(times) else None
+        self.sorted = True
+        self.spline = None
+        self.tables = {}
+    #end def
+    def columns(self):
+        return (self.times, self.lons, self.lats, self.eles, self.data)
+    #end def
+    def point(self, i):
+        data = {}
+        for tag in self.tags:
+            if self.data[tag][i] == self.data[tag][i]:
+                data[tag] = self.data[tag][i]
+            #end if
+        #end for
+        return Point(self.times[i], self.lons[i], self.lats[i], self.eles[i], data)
+    #end def
+    # Lookup tables of a tag for an aggregate, built on first use: for "mean"
+    # the prefix sums and counts of the values, for "min" and "max" a sparse
+    # table whose level k holds the min (max) of every run of 2**k values.
+    # Missing values count as +inf (min) and -inf (max).
+    def table(self, tag, aggregate):
+        key = (tag, aggregate)
+        if key in self.tables:
+            return self.tables[key]
         #end if
-        if self.end is None or self.end < point.timestamp:
-            self.end = point.timestamp
+        values = self.data[tag]
+        n = len(values)
+        if aggregate == "mean":
+            sums = array.array('d', [0.0])
+            counts = array.array('q', [0])
+            total = 0.0
+            count = 0
+            for v in values:
+                if v == v:
+                    total += v
+                    count += 1
+                #end if
+                sums.append(total)
+                counts.append(count)
+            #end for
+            table = (sums, counts)
+        else:
+            pick = min if aggregate == "min" else max
+            missing = float("inf") if aggregate == "min" else float("-inf")
+            level = array.array('d', [v if v == v else missing for v in values])
+            table = [level]
+            width = 1
+            while 2 * width <= n:
+                level = array.array('d', map(pick, level[:n - 2 * width + 1], level[width:n - width + 1]))
+                table.append(level)
+                width *= 2
+            #end while
         #end if
-#end def
+        self.tables[key] = table
+        return table
+    #end def
+    # Aggregate ("mean", "min" or "max") of a tag over all track points within
+    # +-window seconds of timestamp; None if there is no value.
+    def aggregate(self, tag, aggregate, timestamp, window):
+        i = bisect.bisect_left(self.times, timestamp - window)
+        j = bisect.bisect_right(self.times, timestamp + window)
+        if j <= i:
+            return None
+        #end if
+        table = self.table(tag, aggregate)
+        if aggregate == "mean":
+            sums, counts = table
+            count = counts[j] - counts[i]
+            return (sums[j] - sums[i]) / count if count else None
+        #end if
+        k = (j - i).bit_length() - 1
+        level = table[k]
+        value = (min if aggregate == "min" else max)(level[i], level[j - (1 << k)])
+        return None if math.isinf(value) else value
+    #end def
+    # Cubic Hermite tangents (finite differences over the neighbouring points)
+    # for lon, lat and elevation. Computed once per segment on first use and
+    # reused for every interpolated photo.
+    def tangents(self):
+        if self.spline is not None:
+            return self.spline
+        #end if
+        times = self.times
+        n = len(times)
+        spline = []
+        for values in (self.lons, self.lats, self.eles):
+            m = array.array('d', bytes(8 * n))
+            for k in range(n):
+                k0 = max(k - 1, 0)
+                k1 = min(k + 1, n - 1)
+                if times[k1] > times[k0]:
+                    m[k] = (values[k1] - values[k0]) / (times[k1] - times[k0])
+                #end if
+            #end for
+            spline.append(m)
+        #end for
+        self.spline = spline
+        return spline
+    #end def
+    # Interpolates lon, lat and elevation at the given times. Each time comes
+    # with the index of the track point before it; method is "linear" or
+    # "spline".
+    def interpolate(self, requests, method="linear"):
+        results = []
+        columns = (self.lons, self.lats, self.eles)
+        tangents = self.tangents() if method == "spline" else (None, None, None)
+        for t, k in requests:
+            t0 = self.times[k]
+            h = self.times[k+1] - t0
+            s = (t - t0) / h
+            if method == "spline":
+                s2 = s * s
+                s3 = s2 * s
+                h00 = 2*s3 - 3*s2 + 1
+                h10 = s3 - 2*s2 + s
+                h01 = -2*s3 + 3*s2
+                h11 = s3 - s2
+                results.append(tuple(h00*p[k] + h10*h*m[k] + h01*p[k+1] + h11*h*m[k+1] for p, m in zip(columns, tangents)))
+            else:
+                results.append(tuple(p[k] + s * (p[k+1] - p[k]) for p in columns))
+            #end if
+        #end for
+        return results
+    #end def
+    # Time-aware simplification: drops every point whose position differs by
+    # at most <tolerance> metres from the position linearly interpolated in
+    # time between the kept points around it (synchronized euclidean
+    # distance), so linear interpolation over the kept points stays within
+    # the tolerance. Kept points are at most max_gap seconds apart. From each
+    # kept point the window is opened in doubling steps until a check fails
+    # and then narrowed by bisection, so a window of w points costs
+    # O(w log w) distance checks instead of O(w**2). Returns the number of
+    # points kept.
+    def simplify(self, tolerance, max_gap=300):
+        n = len(self.times)
+        if n < 3:
+            return n
+        #end if
+        times = self.times
+        scale = 6371000.0 * math.pi / 180
+        kx = scale * math.cos(math.radians(self.lats[0]))
+        xs = [lon * kx for lon in self.lons]
+        ys = [lat * scale for lat in self.lats]
+        tol2 = tolerance * tolerance
+        def fits(a, e):
+            dt = times[e] - times[a]
+            if dt > max_gap:
+                return False
+            #end if
+            xa, ya = xs[a], ys[a]
+            vx = (xs[e] - xa) / dt if dt else 0.0
+            vy = (ys[e] - ya) / dt if dt else 0.0
+            ta = times[a]
+            for i in range(a + 1, e):
+                dx = xa + vx * (times[i] - ta) - xs[i]
+                dy = ya + vy * (times[i] - ta) - ys[i]
+                if dx * dx + dy * dy > tol2:
+                    return False
+                #end if
+            #end for
+            return True
+        #end def
+        keep = [0]
+        a = 0
+        while a < n - 1:
+            good = a + 1
+            step = 2
+            while a + step < n and fits(a, a + step):
+                good = a + step
+                step *= 2
+            #end while
+            bad = min(a + step, n)
+            while bad - good > 1:
+                mid = (good + bad) // 2
+                if fits(a, mid):
+                    good = mid
+                else:
+                    bad = mid
+                #end if
+            #end while
+            keep.append(good)
+            a = good
+        #end while
+        if len(keep) < n:
+            self.times = array.array('q', [times[i] for i in keep])
+            self.lons = array.array('d', [self.lons[i] for i in keep])
+            self.lats = array.array('d', [self.lats[i] for i in keep])
+            self.eles = array.array('d', [self.eles[i] for i in keep])
+            for tag in self.tags:
+                self.data[tag] = array.array('d', [self.data[tag][i] for i in keep])
+            #end for
+            self.spline = None
+            self.tables = {}
+        #end if
+        return len(keep)
+    #end def
+    def nbytes(self):
+        return 8 * len(self.times) * (4 + len(self.tags))
+    #end def
+    def nearest(self, timestamp, lo=0):
+        i = bisect.bisect_left(self.times, timestamp, lo)
+        if i == len(self.times): return i - 1
+        if i == 0: return 0
+        if self.times[i] - timestamp < timestamp - self.times[i-1]: return i
+        return i - 1
+    #end def
+#end class
 
 class GPXData:
-    def __init__(self, tz=0, to=0):
+    # simplify: tolerance in metres for Segment.simplify() of every segment
+    # read from a gpx file, 0 to keep all points; max_gap: largest time
+    # between two kept points, should not exceed the maxdiff used to match.
+    def __init__(self, tz=0, to=0, simplify=0, max_gap=300):
         self.tz = tz
         self.tz_offset = datetime.timedelta(0, 3600*tz, 0)
         self.to = to
         self.to_offset = datetime.timedelta(0, to, 0)
         self.segment = []
         self.fileno = 0
-        self.start = []
-        self.end = []
+        self.start = None
+        self.end = None
         self.ptno = 0
+        self.index = None
+        self.files = {}
+        self.simplify = simplify
+        self.max_gap = max_gap
     #end def
-    
-    def correlate(self, image, maxdiff=60, tag=None, interpolate=False, overwrite=False):
-        state = set()
-        md_offset = datetime.timedelta(0, maxdiff, 0)
-        ex_offset = datetime.timedelta(0, 1, 0)
-        exif = get_exiv2(image)
-        if exif == "":
-            logging.warn("{}: no exif data - skipped.".format(image))
-            return None
+
+    # Timeline index over all segments: the sorted start and end+1 times of
+    # all segments split the time axis into elementary intervals, and for each
+    # interval the list of segments covering it is stored. A photo time is
+    # mapped to its interval with one bisect; empty intervals are gaps.
+    @stats.timed("build_index")
+    def build_index(self):
+        bounds = sorted(set([s.start for s in self.segment] + [s.end + 1 for s in self.segment]))
+        opening = {}
+        closing = {}
+        for n, segment in enumerate(self.segment):
+            opening.setdefault(segment.start, []).append(n)
+            closing.setdefault(segment.end + 1, []).append(n)
+        #end for
+        covers = []
+        active = set()
+        for bound in bounds:
+            active.difference_update(closing.get(bound, []))
+            active.update(opening.get(bound, []))
+            covers.append(tuple(sorted(active)))
+        #end for
+        self.index = (bounds, covers)
+        gaps = sum(1 for c in covers[:-1] if not c)
+        logging.debug("timeline index: {} segments, {} intervals, {} gaps.".format(len(self.segment), len(bounds), gaps))
+        return self.index
+    #end def
+
+    def covering(self, timestamp):
+        bounds, covers = self.index or self.build_index()
+        k = bisect.bisect_right(bounds, timestamp) - 1
+        if k < 0:
+            return ()
         #end if
-        old_gps = GpsInfo(exif)
-        if old_gps.has_coordinates(): state.add("GPS_PRESENT")
-        dt_original = exif['DateTimeOriginal']
-        dto = exiftime2datetime(dt_original)
-        dtzulu = dto - self.tz_offset - self.to_offset
-        matches = []
-        offsets = []
+        return covers[k]
+    #end def
+
+    def set_time_offset(self, to):
+        self.to = to
+        self.to_offset = datetime.timedelta(0, to, 0)
+    #end def
+
+    # Sorted, disjoint [start, end] intervals of the times match() snaps to a
+    # track point: inside a segment and at most maxdiff from one of its points.
+    def match_intervals(self, maxdiff=60):
+        intervals = []
         for segment in self.segment:
-            if dtzulu < segment.start or dtzulu > segment.end: continue
-            start = 0
-            end = len(segment.points)-1
-            match = None
-            while True:
-                if (end - start) <= 1:
-                    off_start = segment.points[start].timestamp - dtzulu
-                    off_end = segment.points[end].timestamp - dtzulu
-                    if interpolate is True:
-                        print("Interpolation not yet implemented")
-                    #end if
-                    if segment.points[end].timestamp - dtzulu < dtzulu - segment.points[start].timestamp:
-                        match = segment.points[end]
-                        offset = off_end
-                    else:
-                        match = segment.points[start]
-                        offset = off_start
-                    #end if
-                    if match is not None:
-                        matches.append(match)
-                        offsets.append(offset)
-                    #end if
-                    break
+            times = segment.times
+            start = times[0]
+            for prev, t in zip(times, times[1:]):
+                if t - prev > 2 * maxdiff:
+                    intervals.append((start, prev + maxdiff))
+                    start = t - maxdiff
                 #end if
-                mid = (start + end) // 2
-                if dtzulu < segment.points[mid].timestamp:
-                    end = mid
-                else:
-                    start = mid
-                #end if
-            #end while
+            #end for
+            intervals.append((start, times[-1]))
         #end for
-        found = None
-        for matchno in range(len(matches)):
-            if offsets[matchno] > md_offset:
-                state.add("TOO_FAR")
-                continue
-            #end if
-            if offsets[matchno] < ex_offset:
-                state.add("EXACT")
+        intervals.sort()
+        merged = []
+        for start, end in intervals:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
             else:
-                state.add("SNAPPED")
+                merged.append([start, end])
             #end if
-            if found is None or offsets[matchno] < offsets[found]:
-                found = matchno
-            #end if
-            mlon, mlat, mele = [float(x) for x in matches[found].get_gpsinfo()]
-            logging.info("{:s}: matched: {:8.4f} {:8.4f} {:4.0f} error: {:2d}s, old: {:s}".format(image, mlon, mlat, mele, int(offsets[found].total_seconds()), str(old_gps)))
-            set_exiv_gps(image, mlon, mlat, mele)
-            return [matches[found], exif]
         #end for
-        logging.info("{:s}: matched: {:8s} {:8s} {:4s} error: {:2s}s, old: {:s}".format(image, "-", "-", "-", "-", str(old_gps)))
-        return None
+        return merged
     #end def
-        
-    def add_segment(self, segment):
-        self.segment.append(segment)
-        if self.start > segment.timestamp:
-            self.start = segment.timestamp
+
+    # Estimates the camera clock offset (the value of to=) from the photo
+    # times, computed with to=0. A photo at t matches with offset o if t - o
+    # lies in one of the match intervals [a, b], i.e. for o in [t - b, t - a].
+    # A sweep over these ranges gives the number of matches for every offset
+    # within +-limit seconds. The offsets with the most matches are refined by
+    # the mean distance between the track and the photos that already have
+    # coordinates (positions: (lat, lon) or None per photo), then by the mean
+    # time error of match(). Returns (offset, matched, mean error, confidence)
+    # or None. The confidence (0..1) compares the best offset to the offsets
+    # further than 2*maxdiff away: by the tie-breaker (anchor distance or time
+    # error) against those that match within <tolerance> as many photos, by
+    # match count if there are none.
+    @stats.timed("estimate_offset")
+    def estimate_offset(self, times, maxdiff=60, limit=43200, positions=None, tolerance=0.02):
+        if positions is None:
+            positions = [None] * len(times)
         #end if
-        if self.end < segment.timestamp:
-            self.end = segment.timestamp
+        photos = [(t, p) for t, p in zip(times, positions) if t is not None]
+        times = [t for t, p in photos]
+        intervals = self.match_intervals(maxdiff)
+        starts = [a for a, b in intervals]
+        ends = [b for a, b in intervals]
+        events = {}
+        for t in times:
+            for a, b in intervals[bisect.bisect_left(ends, t - limit):bisect.bisect_right(starts, t + limit)]:
+                lo, hi = max(t - b, -limit), min(t - a, limit) + 1
+                events[lo] = events.get(lo, 0) + 1
+                events[hi] = events.get(hi, 0) - 1
+            #end for
+        #end for
+        plateaus = []
+        count = 0
+        keys = sorted(events)
+        for lo, hi in zip(keys, keys[1:]):
+            count += events[lo]
+            if count > 0:
+                plateaus.append((lo, hi - 1, count))
+            #end if
+        #end for
+        if not plateaus:
+            return None
         #end if
-    #end def
-    
-    def add_file(self, gpxfile, tags=[]):
+        best = max(p[2] for p in plateaus)
+        scores = {}
+        def score(offset):
+            if offset not in scores:
+                errors = []
+                distances = []
+                for (t, pos), (m, state) in zip(photos, self.match([t - offset for t in times], maxdiff)):
+                    if m is None:
+                        continue
+                    #end if
+                    errors.append(m[0])
+                    if pos is not None:
+                        segment, i = m[1], m[2]
+                        x = math.radians(segment.lons[i] - pos[1]) * math.cos(math.radians(pos[0]))
+                        distances.append(6371000.0 * math.hypot(x, math.radians(segment.lats[i] - pos[0])))
+                    #end if
+                #end for
+                scores[offset] = (-len(errors), sum(distances) / max(len(distances), 1), sum(errors) / max(len(errors), 1))
+            #end if
+            return scores[offset], abs(offset)
+        #end def
+        # coarse to fine search for the best scored offset in [lo, hi]
+        def refine(lo, hi):
+            step = max(1, (hi - lo) // 16)
+            while True:
+                offset = min(list(range(lo, hi + 1, step)) + [hi], key=score)
+                if step == 1:
+                    return offset
+                #end if
+                lo, hi = max(lo, offset - step), min(hi, offset + step)
+                step = max(1, step // 4)
+            #end while
+        #end def
+        offset = min([refine(lo, hi) for lo, hi, count in plateaus if count == best], key=score)
+        matched, distance, error = score(offset)[0]
+        # rivals: the best offsets further than 2*maxdiff away whose match
+        # count is within <tolerance> of the best one. With continuous tracks
+        # nearly every offset is a rival, and the tie-breaker decides.
+        near = []
+        for lo, hi, count in plateaus:
+            if count < (1.0 - tolerance) * best:
+                continue
+            #end if
+            if near and lo == near[-1][1] + 1:
+                near[-1][1] = hi
+            else:
+                near.append([lo, hi])
+            #end if
+        #end for
+        rivals = []
+        for lo, hi in near:
+            for a, b in ((lo, min(hi, offset - 2 * maxdiff - 1)), (max(lo, offset + 2 * maxdiff + 1), hi)):
+                if a <= b:
+                    rivals.append(score(refine(a, b))[0])
+                #end if
+            #end for
+        #end for
+        if not rivals:
+            second = max([p[2] for p in plateaus if p[1] < offset - 2 * maxdiff or p[0] > offset + 2 * maxdiff] + [0])
+            confidence = 1.0 - float(second) / best
+        else:
+            # the tie is broken by the anchor distance if there are photos
+            # with coordinates, else by the time error
+            k = 1 if any(p is not None for t, p in photos) else 2
+            closest = min(rival[k] for rival in rivals)
+            confidence = max(0.0, 1.0 - scores[offset][k] / closest) if closest > 0 else 0.0
+        #end if
+        return offset, -matched, error, confidence
+    #end def
+
+    def photo_time(self, exif):
+        try:
+            dto = exiftime2datetime(exif['DateTimeOriginal'])
+        except:
+            return None
+        #end try
+        return datetime2epoch(dto - self.tz_offset - self.to_offset)
+    #end def
+
+    # Matches a list of epoch timestamps (None for unknown) against the
+    # timeline index. The timestamps are visited in sorted order, so each
+    # segment's bisect can start at the position of its previous match.
+    # Returns one ((offset, segment, index) or None, state) tuple per timestamp.
+    def match(self, times, maxdiff=60):
+        if self.index is None:
+            self.build_index()
+        #end if
+        candidates = [[] for t in times]
+        hints = [0] * len(self.segment)
+        for t, n in sorted((t, n) for n, t in enumerate(times) if t is not None):
+            for k in self.covering(t):
+                segment = self.segment[k]
+                pos = hints[k] = segment.nearest(t, hints[k])
+                candidates[n].append((abs(segment.times[pos] - t), segment, pos))
+            #end for
+        #end for
+        results = []
+        for n in range(len(times)):
+            state = set()
+            best = None
+            for candidate in candidates[n]:
+                if candidate[0] > maxdiff:
+                    state.add("TOO_FAR")
+                    continue
+                #end if
+                if best is not None:
+                    state.add("MULTI")
+                #end if
+                if best is None or candidate[0] < best[0]:
+                    best = candidate
+                #end if
+            #end for
+            if best is not None:
+                state.add(["SNAPPED", "EXACT"][best[0] < 1])
+            elif times[n] is not None and len(candidates[n]) == 0:
+                state.add("OUT_OF_RANGE")
+            #end if
+            results.append((best, state))
+        #end for
+        return results
+    #end def
+
+    def correlate(self, image, maxdiff=60, tag=None, interpolate=False, overwrite=False, writer=None, window=60):
+        return self.correlate_many([image], maxdiff, tag, interpolate, overwrite, writer, window=window)[0]
+    #end def
+
+    @stats.timed("correlate")
+    # tag: list of tag= values; for every "name:aggregate" the aggregate over
+    # +-window seconds around the photo time is added to the point data.
+    # exif_cache: optional dict of image -> exif data read before, e.g. for to=auto
+    # Returns one [point, exif, state, offset] per image, with point and offset
+    # None if no track point matched, or None if the image could not be read.
+    def correlate_many(self, images, maxdiff=60, tag=None, interpolate=False, overwrite=False, writer=None, exif_cache=None, window=60):
+        stats.count("images", len(images))
+        # without a writer the positions are written to the images right away
+        flush = writer is None
+        if flush:
+            writer = ExivWriter()
+        #end if
+        exif_cache = exif_cache or {}
+        exifs = [exif_cache[image] if image in exif_cache else get_exiv2(image) for image in images]
+        times = [None if exif == "" else self.photo_time(exif) for exif in exifs]
+        matches = self.match(times, maxdiff)
+        if interpolate is True:
+            interpolate = "linear"
+        #end if
+        positions = {}
+        if interpolate:
+            positions = self.interpolate(times, matches, maxdiff, interpolate)
+        #end if
+        results = []
+        for n, image, exif, (best, state) in zip(range(len(images)), images, exifs, matches):
+            if exif == "":
+                logging.warn("{}: no exif data - skipped.".format(image))
+                results.append(None)
+                continue
+            #end if
+            old_gps = GpsInfo(exif)
+            if old_gps.has_coordinates(): state.add("GPS_PRESENT")
+            if 'DateTimeOriginal' not in exif:
+                logging.warn("{}: no DateTimeOriginal - skipped.".format(image))
+                results.append(None)
+                continue
+            #end if
+            if best is None:
+                logging.info("{:s}: matched: {:8s} {:8s} {:4s} error: {:2s}s, old: {:s}".format(image, "-", "-", "-", "-", str(old_gps)))
+                results.append([None, exif, state, None])
+                continue
+            #end if
+            offset, segment, i = best
+            match = segment.point(i)
+            if n in positions:
+                match.timestamp = times[n]
+                match.lon, match.lat, match.elev = positions[n]
+                state.discard("SNAPPED")
+                state.add("INTERPOLATED")
+            #end if
+            for spec in tag or []:
+                name, aggregate = parse_tag(spec)
+                if aggregate is not None and name in segment.data:
+                    value = segment.aggregate(name, aggregate, times[n], window)
+                    if value is not None:
+                        match.data[spec] = value
+                    #end if
+                #end if
+            #end for
+            mlon, mlat, mele = match.get_gpsinfo()
+            logging.info("{:s}: matched: {:8.4f} {:8.4f} {:4.0f} error: {:2d}s, old: {:s}".format(image, mlon, mlat, mele, offset, str(old_gps)))
+            writer.set_gps(image, mlon, mlat, mele)
+            results.append([match, exif, state, 0 if n in positions else offset])
+        #end for
+        if flush:
+            writer.flush()
+        #end if
+        return results
+    #end def
+
+    # Interpolates the position of every matched photo that lies between two
+    # track points which are both within maxdiff. The photos are grouped per
+    # segment so that each segment is interpolated in one batch. Returns a
+    # dict of photo number -> (lon, lat, ele).
+    def interpolate(self, times, matches, maxdiff=60, method="linear"):
+        batches = {}
+        for n, (best, state) in enumerate(matches):
+            if best is None or best[0] == 0:
+                continue
+            #end if
+            t = times[n]
+            segment = best[1]
+            k = bisect.bisect_right(segment.times, t, max(best[2] - 1, 0)) - 1
+            if k < 0 or k + 1 >= len(segment) or t - segment.times[k] > maxdiff or segment.times[k+1] - t > maxdiff:
+                continue
+            #end if
+            batches.setdefault(id(segment), (segment, []))[1].append((n, (t, k)))
+        #end for
+        positions = {}
+        for segment, batch in batches.values():
+            values = segment.interpolate([request for n, request in batch], method)
+            for (n, request), value in zip(batch, values):
+                positions[n] = value
+            #end for
+        #end for
+        return positions
+    #end def
+
+    def add_segment(self, segment, gpxfile=""):
+        segment.finish()
+        if len(segment) == 0:
+            logging.warn("{}: segment does not contain enough data for correlation - skipped.".format(gpxfile))
+            return
+        #end if
+        self.segment.append(segment)
+        self.files.setdefault(gpxfile, []).append(segment)
+        self.index = None
+        if self.start is None or self.start > segment.start:
+            self.start = segment.start
+        #end if
+        if self.end is None or self.end < segment.end:
+            self.end = segment.end
+        #end if
+        logging.info("{}: {} points added.".format(gpxfile, len(segment)))
+    #end def
+
+    # Removes all segments of a gpx file, e.g. before a changed file is read
+    # again. The index is rebuilt on the next match.
+    def remove_file(self, gpxfile):
+        removed = set(id(segment) for segment in self.files.pop(gpxfile, []))
+        if not removed:
+            return
+        #end if
+        self.segment = [segment for segment in self.segment if id(segment) not in removed]
+        self.index = None
+        self.start = min([segment.start for segment in self.segment] or [None])
+        self.end = max([segment.end for segment in self.segment] or [None])
+        logging.info("{}: {} segments removed.".format(gpxfile, len(removed)))
+    #end def
+
+    # Streams the gpx file with iterparse: every trkpt is appended to the
+    # current segment as soon as it is complete and then removed from the
+    # tree, so memory stays bounded by the point store, not by the xml.
+    @stats.timed("add_file")
+    def add_file(self, gpxfile, tags=[], cache=None):
         logging.info("adding gpx: {}".format(gpxfile))
+        if cache is not None:
+            segments = cache.load(gpxfile, tags, self.simplify)
+            if segments is not None:
+                self.fileno += 1
+                for columns in segments:
+                    segment = Segment(tags)
+                    segment.set_columns(*columns)
+                    self.add_segment(segment, gpxfile)
+                #end for
+                logging.info("{}: loaded from track cache.".format(gpxfile))
+                return
+            #end if
+        #end if
         try:
-            gpx = open(gpxfile, 'r')
+            gpx = open(gpxfile, 'rb')
         except:
             logging.error("{}: cannot open file for reading - skipped.".format(gpxfile))
             return
         #end try
+        self.fileno += 1
+        first = len(self.segment)
+        complete = True
+        ext_paths = [(tag, ".//{{{}}}{}".format(Nsp["gpxtpx"], tag)) for tag in tags]
+        t0 = time.time()
+        npoints = 0
+        nbytes = 0
+        path = []
+        segment = None
+        seg_elem = None
         try:
-            tree = ET.parse(gpx)
-            gpx = tree.getroot()
+            for event, elem in ET.iterparse(gpx, events=("start", "end")):
+                name = elem.tag.rsplit('}', 1)[-1]
+                if event == "start":
+                    path.append(name)
+                    if name == "trkseg":
+                        segment = Segment(tags)
+                        seg_elem = elem
+                    #end if
+                    continue
+                #end if
+                path.pop()
+                if name == "trkpt" and segment is not None:
+                    self.ptno += 1
+                    point = self.parse_point(gpxfile, elem, ext_paths)
+                    if point is not None:
+                        segment.append(*point)
+                        npoints += 1
+                    #end if
+                    seg_elem.remove(elem)
+                elif name == "trkseg" and segment is not None:
+                    nbytes += segment.nbytes()
+                    if self.simplify > 0:
+                        segment.simplify(self.simplify, self.max_gap)
+                    #end if
+                    self.add_segment(segment, gpxfile)
+                    segment = seg_elem = None
+                    elem.clear()
+                elif name == "name" and path and path[-1] == "trk":
+                    logging.info("{}: track name is '{}'".format(gpxfile, elem.text))
+                elif name == "trk":
+                    elem.clear()
+                #end if
+            #end for
+        except ET.ParseError as e:
+            logging.error("{}: xml error ({}) - rest of file skipped.".format(gpxfile, e))
+            complete = False
+        finally:
+            gpx.close()
+        #end try
+        elapsed = max(time.time() - t0, 1e-6)
+        logging.info("{}: {} points read in {:.2f}s ({:.0f} points/s).".format(gpxfile, npoints, elapsed, npoints / elapsed))
+        if self.simplify > 0:
+            kept = sum(len(segment) for segment in self.segment[first:])
+            logging.info("{}: simplified to {} of {} points within {:g}m, {:.2f} MB -> {:.2f} MB.".format(gpxfile, kept, npoints,
+                self.simplify, nbytes / 1048576.0, sum(segment.nbytes() for segment in self.segment[first:]) / 1048576.0))
+        #end if
+        if cache is not None and complete:
+            cache.store(gpxfile, tags, [segment.columns() for segment in self.segment[first:]], self.simplify)
+        #end if
+    #end def
+
+    def parse_point(self, gpxfile, pt, ext_paths):
+        try:
+            lon = float(pt.get("lon"))
+            lat = float(pt.get("lat"))
         except:
-            logging.error("{}: no xml root found - skipped.".format(gpxfile))
-            return
+            logging.debug("{}: invalid coordinates - track point skipped.".format(gpxfile))
+            return None
+        #end try
+        ts = pt.findtext(GPX_TIME)
+        if ts is None:
+            logging.debug("{}: no timestamp for {},{} - track point skipped.".format(gpxfile, lon, lat))
+            return None
+        #end if
+        try:
+            timestamp = gpxtime2epoch(ts)
+        except:
+            logging.debug("{}: invalid timestamp '{}' - track point skipped.".format(gpxfile, ts))
+            return None
         #end try
+        try:
+            ele = float(pt.findtext(GPX_ELE))
+        except:
+            ele = NAN
+        #end try
+        data = None
+        if ext_paths:
+            data = {}
+            for tag, ext_path in ext_paths:
+                try:
+                    data[tag] = float(pt.findtext(ext_path))
+                except (TypeError, ValueError):
+                    pass
+                #end try
+            #end for
+        #end if
+        return timestamp, lon, lat, ele, data
+    #end def
+#end class
 
-        self.fileno += 1
-                
-        trackno = 0
-        for track in gpx.findall('gpx:trk', Nsp):
-            trackno += 1
+#===============================================================================
+# Stay-point clustering of matched positions, so that one place lookup covers
+# a whole burst of photos. Positions are visited in time order; a position
+# joins the current stay point while it is within <radius> metres of the stay
+# point's first position (its anchor), otherwise it starts a new one. Stay
+# points whose anchors are within <radius> of an earlier anchor are merged
+# into that one via a grid with cell size <radius>, so revisits share a name
+# too. Comparing against anchors only avoids chaining along a walk.
+# positions: list of (lat, lon, timestamp); returns the index of the
+# representative (anchor) position for every position.
+#===============================================================================
+def cluster_positions(positions, radius):
+    def distance(a, b):
+        x = math.radians(b[1] - a[1]) * math.cos(math.radians((a[0] + b[0]) / 2))
+        y = math.radians(b[0] - a[0])
+        return 6371000.0 * math.hypot(x, y)
+    #end def
+    cell = radius / 111320.0
+    grid = {}
+    anchors = {}
+    representative = [None] * len(positions)
+    anchor = None
+    for n in sorted(range(len(positions)), key=lambda n: positions[n][2]):
+        p = positions[n]
+        if anchor is not None and distance(positions[anchor], p) <= radius:
+            representative[n] = anchors[anchor]
+            continue
+        #end if
+        anchor = n
+        anchors[n] = n
+        scale = max(math.cos(math.radians(p[0])), 0.01)
+        gx, gy = int(math.floor(p[0] / cell)), int(math.floor(p[1] * scale / cell))
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for other in grid.get((gx + dx, gy + dy), []):
+                    if anchors[n] == n and distance(positions[other], p) <= radius:
+                        anchors[n] = other
+                    #end if
+                #end for
+            #end for
+        #end for
+        if anchors[n] == n:
+            grid.setdefault((gx, gy), []).append(n)
+        #end if
+        representative[n] = anchors[n]
+    #end for
+    return representative
+#end def
+
+def build_comment(image, match, exif, options, place=None):
+    data = match.get_data()
+    if options['comment'] == "clear":
+        comment = newcomment = ""
+    else:
+        try:
+            comment = newcomment = exif['UserComment']
+        except:
+            logger.warn('{}: missing UserComment exif tag'.format(image))
+            comment = newcomment = ""
+        #end try
+    #endif
+    if len(comment) == 0:
+        delimiter = ""
+    else:
+        delimiter = ", "
+    #end if 
+    if place is not None and not place in newcomment:
+        newcomment = newcomment + delimiter + place
+        delimiter = ", "
+    #end if
+    for tag in options['tag']:
+        try:
+            formatted_value = Tags[tag][0].format(value=data[tag])
+        except:
             try:
-                name = track.find('gpx:name', Nsp).text
-                logging.info("{}: track name is '{}'".format(gpxfile, name))
+                formatted_value = "{}={:g}".format(tag, data[tag])
             except:
-                logging.warn("{}: no track name".format(gpxfile))
+                formatted_value = None
             #end try
+        #end try
+        if tag in data and not formatted_value is None and not formatted_value in newcomment:   
+            newcomment = newcomment + delimiter + formatted_value
+            delimiter = ", "
+        #end if
+    #end for
+    return comment, newcomment
+#end def
 
-            segno = 0
-            for seg in track.findall('gpx:trkseg', Nsp):
-                segment = Segment()
-                segno += 1
-                for pt in seg.findall('gpx:trkpt', Nsp):
-                    self.ptno += 1
-                    lon = pt.get("lon")
-                    lat = pt.get("lat")
-                    data = {}
-                    try:
-                        ele = pt.find("gpx:ele", Nsp).text
-                    except:
-                        logging.debug("{}: no elevation for {},{}".format(gpxfile, lon, lat))
-                    #end try                        
-                    try:
-                        ts = pt.find("gpx:time", Nsp).text
-                    except:
-                        logging.debug("{}: no timestamp for {},{} - track point skipped.".format(gpxfile, lon, lat))
-                        continue
-                    #end try
-                    timestamp = gpxtime2datetime(ts)
-                    for tag in tags: 
-                        try: 
-                            data[tag] = pt.find(".//gpxtpx:{}".format(tag), Nsp).text
-                        except: pass
-                    #end if
-                    point = Point(timestamp, lon, lat, ele, data)
-                    segment.add_point(point)
-                #end for
-                if len(segment) == 0:
-                    logging.warn("{}: segment does not contain enough data for correlation - skipped.".format(gpxfile))
-                else:
-                    self.segment.append(segment)
-                    logging.info("{}: {} points added.".format(gpxfile, len(segment)))
-                #end if
+def ratio(hits, misses):
+    return round(hits / (hits + misses), 3) if hits + misses else None
+#end def
+
+def run_summary(states, url_cache=None, track_cache=None, gpx_catalog=None, image_journal=None):
+    histogram = dict((key, 0) for key in States if key != "NONE")
+    for state in states.values():
+        for key in state:
+            histogram[key] += 1
+        #end for
+    #end for
+    summary = {"states": histogram}
+    if url_cache is not None:
+        place_cache = dict(url_cache.stats)
+        place_cache["gps_hit_ratio"] = ratio(url_cache.stats["gps_hit"], url_cache.stats["gps_miss"])
+        place_cache["bb_hit_ratio"] = ratio(url_cache.stats["bb_hit"], url_cache.stats["bb_miss"])
+        summary["place_cache"] = place_cache
+    #end if
+    if track_cache is not None:
+        summary["track_cache"] = {"hits": track_cache.hits, "misses": track_cache.misses,
+            "hit_ratio": ratio(track_cache.hits, track_cache.misses)}
+    #end if
+    if gpx_catalog is not None:
+        summary["gpx_catalog"] = {"hits": gpx_catalog.hits, "misses": gpx_catalog.misses,
+            "hit_ratio": ratio(gpx_catalog.hits, gpx_catalog.misses)}
+    #end if
+    if image_journal is not None:
+        summary["journal"] = {"skipped": image_journal.skipped}
+    #end if
+    return summary
+#end def
+
+# Keeps the gpx files whose span, padded by <pad> seconds, contains at least
+# one photo time. Files without a known span are kept.
+def select_tracks(gpxfiles, spans, times, pad):
+    times = sorted(t for t in times if t is not None)
+    selected = []
+    for gpxfile in gpxfiles:
+        span = spans.get(gpxfile)
+        if span is not None:
+            k = bisect.bisect_left(times, span[0] - pad)
+            if k == len(times) or times[k] > span[1] + pad:
+                logging.debug("{}: no photos between {} and {} - skipped.".format(gpxfile, span[0], span[1]))
+                continue
+            #end if
+        #end if
+        selected.append(gpxfile)
+    #end for
+    return selected
+#end def
+
+def matched_state(state):
+    return state is not None and not state.isdisjoint(("EXACT", "SNAPPED", "INTERPOLATED"))
+#end def
+
+# Reads, correlates, geocodes and writes one set of images; returns the
+# states of the images.
+def process_images(imagefiles, gpxdata, writer, geocoder, pool, ordered_log, options, maxdiff=300, interpolate=False, cluster=0, exif_cache=None, window=60):
+    states = {}
+    # read and correlate in parallel, everything else runs on this thread in
+    # image order, so geocoding stays on a single rate limited lane.
+    chunks = [imagefiles[i:i+64] for i in range(0, len(imagefiles), 64)]
+    correlated = pool.map(lambda chunk: ordered_log.run(gpxdata.correlate_many, chunk, maxdiff=maxdiff, tag=options['tag'], interpolate=interpolate, writer=writer, exif_cache=exif_cache, window=window), chunks)
+    def correlated_images():
+        for results, records in correlated:
+            ordered_log.emit(records)
+            for result in results:
+                yield result
             #end for
         #end for
     #end def
-#end class
+    matched = []
+    for image, result in zip(imagefiles, correlated_images()):
+        if result is None:
+            writer.set_info(image, state=[])
+            continue
+        #end if
+        states[image] = result[2]
+        if result[0] is None:
+            writer.set_info(image, state=sorted(result[2]))
+            continue
+        #end if
+        matched.append((image, result))
+        if geocoder is not None and cluster <= 0:
+            lon, lat, ele = result[0].get_gpsinfo()
+            geocoder.submit(float(lat), float(lon), os.path.basename(image))
+        #end if
+    #end for
+    # position used for the place lookup of every matched image
+    lookups = [(float(r[0].lat), float(r[0].lon)) for image, r in matched]
+    if geocoder is not None and cluster > 0:
+        positions = [(lat, lon, r[0].timestamp) for (lat, lon), (image, r) in zip(lookups, matched)]
+        representative = cluster_positions(positions, cluster)
+        lookups = [lookups[k] for k in representative]
+        logging.info("{} images in {} place clusters.".format(len(matched), len(set(representative))))
+        for (image, result), (lat, lon) in zip(matched, lookups):
+            geocoder.submit(lat, lon, os.path.basename(image))
+        #end for
+    #end if
+    # the geocoder resolves places in the background; comments are built in
+    # image order as the places arrive, and finished images are written in
+    # between so exiv2 runs while the geocoder waits for Nominatim.
+    finished = []
+    for (image, result), (lat, lon) in zip(matched, lookups):
+        place = None
+        if geocoder is not None:
+            place = geocoder.get(lat, lon, os.path.basename(image))
+        #end if
+        comment, newcomment = build_comment(image, result[0], result[1], options, place)
+        if newcomment != comment:
+            logging.debug("UserComment '{}' -> '{}'".format(comment, newcomment))
+            writer.set_comment(image, newcomment)
+        #end if
+        writer.set_info(image, offset=result[3], state=sorted(result[2]), place=place)
+        # only finished images are written early; the GPS data of the others
+        # stays pending so every image is written once
+        finished.append(image)
+        if geocoder is not None and len(finished) >= writer.batch * writer.jobs:
+            writer.flush(finished)
+            finished = []
+        #end if
+    #end for
+    results = writer.flush()
+    for image in imagefiles:
+        if image in results:
+            states.setdefault(image, set()).add(results.pop(image))
+        #end if
+    #end for
+    return states
+#end def
+
+# Logs the final state of every image and records it in the journal.
+# times: dict image -> photo time, if known; the journal fingerprints the gpx
+# files covering it (see journal.Tracks).
+def finish_images(imagefiles, states, image_journal=None, fingerprint=None, tracks=None, times=None):
+    for image in imagefiles:
+        if image in states:
+            logging.info("{}: {}".format(image, ", ".join(sorted(States[s] for s in states[image]))))
+        #end if
+    #end for
+    if image_journal is not None:
+        records = []
+        for image in imagefiles:
+            state = states.get(image, set())
+            if "WRITE_FAILED" not in state:
+                records.append((image, ",".join(sorted(state)) or "NO_MATCH", (times or {}).get(image)))
+            #end if
+        #end for
+        image_journal.record(records, fingerprint, tracks)
+    #end if
+#end def
 
 def help():
-    print("usage: gpxcorrelate [-v] [tz=<hours>] [to=<seconds>] [place=<true|false>] <gpxfiles> -- <imagefiles>")
+    print("usage: gpxcorrelate [-v] [tz=<hours>] [to=<seconds|auto>] [torange=<seconds>] [place=<true|false|bbox|offline>] [batch=<images>] [jobs=<n>] [trackcache=<MB|false>] [interpolate=<false|linear|spline>] [simplify=<metres>] [nominatim=<url>] [gazetteer=<file>] [cluster=<metres>] [tag=<tag[:mean|min|max]>] [window=<seconds>] [stats=<text|json>] [journal=<true|false|file>] [catalog=<true|false|file>] [output=<exif|xmp>] [sidecar=<stem|full>] [watch=<seconds>] [shard=<i/N>] [results=<file>] <gpxfiles|dirs> -- <imagefiles|dirs>")
+    print("       gpxcorrelate [output=<exif|xmp>] [sidecar=<stem|full>] [batch=<images>] [jobs=<n>] apply=<resultfile> [apply=<resultfile> ...]")
     print("tz: timezone +- 12 hours")
-    print("to: time offset in seconds")
+    print("to: time offset in seconds, auto to estimate it from the photo and track times")
+    print("torange: largest time offset in seconds tried by to=auto")
+    print("place: true looks up place names with Nominatim, bbox also reuses a cached place whose bounding box contains the position, offline uses a local GeoNames dump")
+    print("batch: number of sidecars (output=xmp) or result records written per job; output=exif always writes one exiv2 call per image")
+    print("jobs: number of images read, correlated and written in parallel")
+    print("trackcache: size limit of the parsed track cache in MB, false to disable")
+    print("interpolate: false (snap to the closest track point), linear or spline")
+    print("simplify: drop track points that linear interpolation reproduces within this many metres (0: off)")
+    print("nominatim: url of the Nominatim reverse geocoding endpoint")
+    print("gazetteer: GeoNames dump or index file used by place=offline")
+    print("cluster: look up one place for all images within this many metres (0: off)")
+    print("tag: add the value of a gpx extension tag (e.g. atemp, hr, cad) to the UserComment; tag:mean, tag:min or tag:max aggregate over the window")
+    print("window: +- seconds around the photo time for tag aggregates")
+    print("stats: print timings, counters and cache statistics at the end (text or json)")
+    print("journal: skip images processed before with the same tracks and options (true, false or journal file)")
+    print("catalog: read the photo times first and only load gpx files whose time span overlaps them (true, false or catalog file)")
+    print("output: exif writes into the images, xmp writes .xmp sidecar files and leaves the images untouched")
+    print("sidecar: name of the xmp sidecar of IMG_1.CR2, stem: IMG_1.xmp (Lightroom, exiv2), full: IMG_1.CR2.xmp (darktable, digiKam)")
+    print("shard: only process the images of shard i of N (0 <= i < N), chosen by a hash of the image path")
+    print("results: write the results to this file instead of the images, for apply=")
+    print("apply: merge result files (duplicates: best match wins) and write them to the images")
+    print("watch: keep running and poll the gpx and image files or directories every <seconds> for new files")
 #end def
     
 def main(args):
@@ -360,8 +1784,21 @@ def main(args):
         'to': '0',
         'tag' : [],
         'comment' : 'append',
+        'jobs' : '1',
+        'trackcache' : '256',
+        'interpolate' : 'false',
+        'cluster' : '0',
+        'stats' : 'false',
+        'journal' : 'true',
+        'output' : 'exif',
+        'sidecar' : 'stem',
+        'torange' : '43200',
+        'window' : '60',
+        'simplify' : '0',
+        'catalog' : 'true',
+        'apply' : [],
         }
-    url_cache = gps2name.Urlcache()
+    url_cache = None
     gpxfiles = []
     imagefiles = []
     files = gpxfiles
@@ -381,8 +1818,8 @@ def main(args):
         if match is not None:
                 
             key, val = match.groups()
-            if key == 'tag':
-                options['tag'].append(val)
+            if key in ('tag', 'apply'):
+                options[key].append(val)
             else:
                 options[key] = val
             #end if
@@ -403,69 +1840,325 @@ def main(args):
         strhd.setFormatter(formatter)
         logger.addHandler(strhd)
     #end if
+    if options['stats'] not in ('false', 'text', 'json'):
+        print("{} is not a valid stats format (text or json)".format(options['stats']))
+        return
+    elif options['stats'] != 'false':
+        stats.enable()
+    #end if
     try:
         tz = int(options['tz'])
     except:
         print("{} is not a valid timezone offset (-12 .. +12)".format(tz))
     #end try
+    auto_offset = options['to'] == 'auto'
     try:
-        to = int(options['to'])
+        to = 0 if auto_offset else int(options['to'])
+        torange = int(options['torange'])
     except:
-        print("{} is not a valid time offset (number of seconds)".format(tz))
+        print("{} is not a valid time offset (number of seconds or auto)".format(options['to']))
+        return
     #end try
-    gpxdata = GPXData(tz, to)
+    try:
+        jobs = max(1, int(options['jobs']))
+    except:
+        print("{} is not a valid number of jobs".format(options['jobs']))
+        return
+    #end try
+    if options['output'] not in Writers:
+        print("{} is not a valid output (exif or xmp)".format(options['output']))
+        return
+    #end if
+    try:
+        batch = int(options.get('batch', '50'))
+    except:
+        print("{} is not a valid batch size (number of images)".format(options['batch']))
+        return
+    #end try
+    if 'batch' in options and options['output'] == 'exif' and 'results' not in options:
+        print("batch= has no effect with output=exif (one exiv2 call per image)")
+    #end if
+    writer_options = {}
+    if options['output'] == 'xmp':
+        if options['sidecar'] not in Sidecar_names:
+            print("{} is not a valid sidecar name (stem or full)".format(options['sidecar']))
+            return
+        #end if
+        writer_options['sidecar'] = options['sidecar']
+    #end if
+    if options['apply']:
+        # merge result files of earlier (sharded) runs and write them
+        writer = Writers[options['output']](batch=batch, jobs=jobs, **writer_options)
+        try:
+            states = apply_results(options['apply'], writer)
+        except (OSError, KeyError, ValueError) as e:
+            print("cannot read result files ({})".format(e))
+            return
+        #end try
+        finish_images(sorted(states), states)
+        if options['stats'] != 'false':
+            print(stats.report(options['stats'], run_summary(states)))
+        #end if
+        return
+    #end if
+    if 'results' in options:
+        try:
+            writer = ResultWriter(options['results'], batch=batch, jobs=jobs)
+        except OSError as e:
+            print("{}: cannot write results ({})".format(options['results'], e))
+            return
+        #end try
+        # the result file is rewritten on every run, so no image may be skipped
+        options['journal'] = 'false'
+    else:
+        writer = Writers[options['output']](batch=batch, jobs=jobs, **writer_options)
+    #end if
+    shard = None
+    if 'shard' in options:
+        try:
+            shard = tuple(int(n) for n in options['shard'].split("/"))
+            assert len(shard) == 2 and 0 <= shard[0] < shard[1]
+        except:
+            print("{} is not a valid shard (i/N with 0 <= i < N)".format(options['shard']))
+            return
+        #end try
+    #end if
+    interpolate = options['interpolate'].lower()
+    if interpolate in ('no', 'false', '0'):
+        interpolate = False
+    elif interpolate in ('yes', 'true', '1'):
+        interpolate = "linear"
+    elif interpolate not in ('linear', 'spline'):
+        print("{} is not a valid interpolation (false, linear or spline)".format(options['interpolate']))
+        return
+    #end if
+    track_cache = None
+    if options['trackcache'].lower() not in ('no', 'false', '0'):
+        t0 = time.perf_counter()
+        try:
+            track_cache = trackcache.TrackCache(limit=int(float(options['trackcache']) * 1024 * 1024))
+        except ValueError:
+            print("{} is not a valid track cache size (MB)".format(options['trackcache']))
+            return
+        #end try
+        stats.started("track cache", t0)
+    #end if
+    tags = []
+    for spec in options['tag']:
+        name, aggregate = parse_tag(spec)
+        if aggregate is not None and aggregate not in Aggregates:
+            print("{} is not a valid tag aggregate (mean, min or max)".format(aggregate))
+            return
+        #end if
+        if name not in tags:
+            tags.append(name)
+        #end if
+    #end for
+    try:
+        window = int(options['window'])
+    except ValueError:
+        print("{} is not a valid window (seconds)".format(options['window']))
+        return
+    #end try
+    try:
+        simplify = float(options['simplify'])
+    except ValueError:
+        print("{} is not a valid simplification tolerance (metres)".format(options['simplify']))
+        return
+    #end try
+    if simplify > 0 and not interpolate:
+        # the tolerance holds for positions interpolated between the kept points
+        logging.info("simplify={}: using linear interpolation.".format(options['simplify']))
+        interpolate = "linear"
+    #end if
+    try:
+        cluster = float(options['cluster'])
+    except ValueError:
+        print("{} is not a valid cluster radius (metres)".format(options['cluster']))
+        return
+    #end try
+    watch_interval = None
+    if 'watch' in options:
+        try:
+            watch_interval = float(options['watch'])
+            assert watch_interval > 0
+        except:
+            print("{} is not a valid watch interval (seconds)".format(options['watch']))
+            return
+        #end try
+    #end if
+    # directories given as gpx or image files are expanded here and, with
+    # watch=, polled for new files later
+    gpx_watcher = watch.Watcher(gpxfiles, lambda name: name.lower().endswith(".gpx"))
+    image_watcher = watch.Watcher(imagefiles, lambda name: not name.startswith(".") and not name.lower().endswith(Watch_ignore))
+    gpxfiles = gpx_watcher.files()
+    imagefiles = image_watcher.files()
+    if shard is not None:
+        total = len(imagefiles)
+        imagefiles = [image for image in imagefiles if shard_of(image, shard[1]) == shard[0]]
+        logging.info("shard {}/{}: {} of {} images.".format(shard[0], shard[1], len(imagefiles), total))
+    #end if
+    place = options.get('place', 'false').lower()
+    geocoder = None
+    if place in ('yes', 'true', '1', 'nominatim', 'bbox'):
+        gps2name = stats.load("gps2name")
+        t0 = time.perf_counter()
+        url_cache = gps2name.Urlcache()
+        stats.started("place cache", t0)
+        geocoder = gps2name.Geocoder(url_cache, url=options.get('nominatim'), bbox=place == 'bbox')
+    elif place == 'offline':
+        gazetteer = stats.load("gazetteer")
+        gazetteer_file = options.get('gazetteer', os.path.join(os.environ["HOME"], ".cache", "gpxcorrelate", "gazetteer.idx"))
+        t0 = time.perf_counter()
+        try:
+            geocoder = gazetteer.OfflineGeocoder(gazetteer_file)
+        except (OSError, ValueError) as e:
+            print("{}: cannot open gazetteer ({})".format(gazetteer_file, e))
+            return
+        #end try
+        stats.started("gazetteer", t0)
+    #end if
+    maxdiff = 300
+    gpxdata = GPXData(tz, to, simplify=simplify, max_gap=maxdiff)
+    ordered_log = OrderedLog()
+    logging.getLogger().addFilter(ordered_log)
+    pool = concurrent.futures.ThreadPoolExecutor(jobs)
+    gpx_catalog = None
+    if options['catalog'].lower() not in ('no', 'false', '0') and watch_interval is None:
+        catalog_file = None if options['catalog'].lower() in ('yes', 'true', '1') else options['catalog']
+        t0 = time.perf_counter()
+        try:
+            gpx_catalog = catalog.Catalog(gpxtime2epoch, catalog_file)
+        except (OSError, sqlite3.Error) as e:
+            print("cannot open gpx catalog ({})".format(e))
+            return
+        #end try
+        stats.started("catalog", t0)
+    #end if
+    # gpx files are selected (and fingerprinted for the journal) by their
+    # span padded by the largest time difference to a photo they can match
+    pad = maxdiff + (torange if auto_offset else 0)
+    spans = gpx_catalog.spans(gpxfiles) if gpx_catalog is not None else {}
+    image_journal = None
+    run_fingerprint = None
+    run_tracks = None
+    if options['journal'].lower() not in ('no', 'false', '0'):
+        journal_file = None if options['journal'].lower() in ('yes', 'true', '1') else options['journal']
+        t0 = time.perf_counter()
+        try:
+            image_journal = journal.Journal(journal_file)
+        except (OSError, sqlite3.Error) as e:
+            print("cannot open journal ({})".format(e))
+            return
+        #end try
+        stats.started("journal", t0)
+        run_fingerprint = journal.fingerprint(dict((key, options.get(key)) for key in Journal_options))
+        run_tracks = journal.Tracks(gpxfiles, spans, pad)
+        total = len(imagefiles)
+        imagefiles = [image for image in imagefiles if not image_journal.unchanged(image, run_fingerprint, run_tracks)]
+        logging.info("{} of {} images unchanged since the last run - skipped.".format(total - len(imagefiles), total))
+    #end if
+    exif_cache = {}
+    times = []
+    positions = []
+    if (auto_offset or gpx_catalog is not None) and imagefiles:
+        # the photo times are read once; correlation reuses the exif data
+        exif_cache = dict(zip(imagefiles, pool.map(get_exiv2, imagefiles)))
+        for exif in exif_cache.values():
+            gps = GpsInfo(exif or {})
+            times.append(None if exif == "" else gpxdata.photo_time(exif))
+            positions.append((gps.latitude, gps.longitude) if gps.has_coordinates() else None)
+        #end for
+    #end if
+    if not imagefiles and watch_interval is None:
+        # nothing to correlate, e.g. all images were skipped by the journal
+        gpxfiles = []
+    elif gpx_catalog is not None and imagefiles:
+        total = len(gpxfiles)
+        gpxfiles = select_tracks(gpxfiles, spans, times, pad)
+        logging.info("{} of {} gpx files overlap the photos.".format(len(gpxfiles), total))
+    #end if
     for gpxfile in gpxfiles:
-        gpxdata.add_file(gpxfile, tags=options['tag'])
+        gpxdata.add_file(gpxfile, tags=tags, cache=track_cache)
     #end if
-    for image in imagefiles:
-        result = gpxdata.correlate(image, maxdiff=300)
-        if result is None: continue
-        lon, lat, ele = result[0].get_gpsinfo()
-        data = result[0].get_data()
-        exif = result[1]
-        if options['comment'] == "clear":
-            comment = newcomment = ""
+    gpxdata.build_index()
+    if auto_offset and imagefiles:
+        estimate = gpxdata.estimate_offset(times, maxdiff=maxdiff, limit=torange, positions=positions)
+        if estimate is None:
+            print("to=auto: no time offset within +-{}s matches any photo, using to=0".format(torange))
         else:
-            try:
-                comment = newcomment = exif['UserComment']
-            except:
-                logger.warn('{}: missing UserComment exif tag'.format(image))
-                comment = newcomment = ""
-            #end try
-        #endif
-        if len(comment) == 0:
-            delimiter = ""
-        else:
-            delimiter = ", "
-        #end if 
-        if 'place' in options and options['place'].lower() in ('yes', 'true', '1'):
-            #status, place = gps2name.gps2name(lon, lat)
-            place = gps2name.gps2name(float(lat), float(lon), image=os.path.basename(image), url_cache=url_cache)
-            if place is not None and not place in newcomment:
-                newcomment = newcomment + delimiter + place
-                delimiter = ", "
-            #end if
-        #end if
-        for tag in options['tag']:
-            try:
-                formatted_value = Tags[tag][0].format(value=data[tag])
-            except:
-                try:
-                    formatted_value = "{}={}".format(tag, data[tag])
-                except:
-                    formatted_value = None
-                #end try
-            #end try
-            if tag in data and not formatted_value is None and not formatted_value in newcomment:   
-                newcomment = newcomment + delimiter + formatted_value
-                delimiter = ", "
+            estimated, matched, error, confidence = estimate
+            print("to=auto: time offset {}s ({} of {} photos matched, mean error {:.1f}s, confidence {:.2f})".format(
+                estimated, matched, len([t for t in times if t is not None]), error, confidence))
+            if confidence < Auto_offset_confidence:
+                print("to=auto: WARNING: confidence below {}, other offsets fit about as well - using to=0. Give to={} to use the estimate anyway.".format(
+                    Auto_offset_confidence, estimated))
+            else:
+                to = estimated
+                gpxdata.set_time_offset(to)
             #end if
-        #end for
-        if newcomment != comment:
-            logging.debug("UserComment '{}' -> '{}'".format(comment, newcomment))
-            set_exiv_comment(image, newcomment)
         #end if
-    #end for
-        
+    #end if
+    states = process_images(imagefiles, gpxdata, writer, geocoder, pool, ordered_log, options,
+        maxdiff=maxdiff, interpolate=interpolate, cluster=cluster, exif_cache=exif_cache, window=window)
+    finish_images(imagefiles, states, image_journal, run_fingerprint, run_tracks, dict(zip(imagefiles, times)))
+    if watch_interval is not None:
+        # tracks and caches stay loaded; new or changed gpx files are merged
+        # into the index and images that did not match before are tried again
+        gpx_watcher.done(gpxfiles)
+        image_watcher.done(list(image_watcher.seen))
+        unmatched = set(image for image in imagefiles if not matched_state(states.get(image)))
+        print("watching {} for new images every {}s, ctrl-c to stop".format(", ".join(image_watcher.paths), watch_interval))
+        try:
+            while True:
+                time.sleep(watch_interval)
+                changed = gpx_watcher.poll()
+                if changed:
+                    for gpxfile in changed:
+                        gpxdata.remove_file(gpxfile)
+                        gpxdata.add_file(gpxfile, tags=tags, cache=track_cache)
+                    #end for
+                    gpx_watcher.done(changed)
+                    gpxdata.build_index()
+                    if image_journal is not None:
+                        run_tracks = journal.Tracks(list(gpx_watcher.seen))
+                    #end if
+                #end if
+                new = image_watcher.poll()
+                if shard is not None:
+                    new = [image for image in new if shard_of(image, shard[1]) == shard[0]]
+                #end if
+                if changed:
+                    new = sorted(set(new) | set(image for image in unmatched if image in image_watcher.seen))
+                #end if
+                if not new:
+                    continue
+                #end if
+                new_states = process_images(new, gpxdata, writer, geocoder, pool, ordered_log, options,
+                    maxdiff=maxdiff, interpolate=interpolate, cluster=cluster, window=window)
+                finish_images(new, new_states, image_journal, run_fingerprint, run_tracks)
+                image_watcher.done(new)
+                for image in new:
+                    if matched_state(new_states.get(image)):
+                        unmatched.discard(image)
+                    else:
+                        unmatched.add(image)
+                    #end if
+                #end for
+                states.update(new_states)
+            #end while
+        except KeyboardInterrupt:
+            pass
+        #end try
+    #end if
+    if geocoder is not None:
+        geocoder.close()
+    #end if
+    pool.shutdown()
+    logging.getLogger().removeFilter(ordered_log)
+    if options['stats'] != 'false':
+        print(stats.report(options['stats'], run_summary(states, url_cache, track_cache, gpx_catalog, image_journal)))
+    #end if
+
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,122 @@
+#===============================================================================
+# Journal of processed images for gpxcorrelate. For every image it records
+# path, size and mtime after processing, the fingerprint of the options used,
+# the photo time, the fingerprint of the gpx files covering that time and the
+# outcome. On the next run an image whose size, mtime and fingerprints are
+# unchanged is skipped after a single stat() call, without reading it. The
+# journal is a SQLite database in ~/.cache/gpxcorrelate/journal.sqlite.
+#===============================================================================
+import os
+import time
+import bisect
+import hashlib
+import sqlite3
+
+# journals of older versions fingerprinted all gpx files at once
+VERSION = 1
+
+# The fingerprint covers the options that influence the result, so changing
+# e.g. the time offset makes all images eligible again.
+def fingerprint(options):
+    h = hashlib.sha1()
+    for key in sorted(options):
+        h.update("{}={}\n".format(key, options[key]).encode("utf-8"))
+    #end for
+    return h.hexdigest()
+#end def
+
+# Fingerprints of the gpx files (path, size and mtime) that can match a photo
+# time. spans: dict gpxfile -> (first, last) track point time or None, see
+# catalog.py; a file covers the times within its span padded by <pad>
+# seconds, files without a known span cover every time. A new track of
+# another trip thus leaves the images of all other trips skipped.
+class Tracks:
+    def __init__(self, gpxfiles, spans=None, pad=0):
+        spans = spans or {}
+        self.gpxfiles = sorted(os.path.abspath(f) for f in gpxfiles)
+        self.always = sorted(os.path.abspath(f) for f in gpxfiles if spans.get(f) is None)
+        self.spans = sorted((spans[f][0] - pad, spans[f][1] + pad, os.path.abspath(f)) for f in gpxfiles if spans.get(f) is not None)
+        self.starts = [span[0] for span in self.spans]
+        self.fingerprints = {}
+    #end def
+
+    def covering(self, t):
+        if t is None:
+            return self.gpxfiles
+        #end if
+        k = bisect.bisect_right(self.starts, t)
+        return sorted(self.always + [f for start, end, f in self.spans[:k] if end >= t])
+    #end def
+
+    def fingerprint(self, t):
+        files = tuple(self.covering(t))
+        if files not in self.fingerprints:
+            h = hashlib.sha1()
+            for gpxfile in files:
+                try:
+                    st = os.stat(gpxfile)
+                    h.update("{}\0{}\0{}\n".format(gpxfile, st.st_size, st.st_mtime_ns).encode("utf-8"))
+                except OSError:
+                    h.update("{}\0-\n".format(gpxfile).encode("utf-8"))
+                #end try
+            #end for
+            self.fingerprints[files] = h.hexdigest()
+        #end if
+        return self.fingerprints[files]
+    #end def
+#end class
+
+class Journal:
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.environ["HOME"], ".cache", "gpxcorrelate", "journal.sqlite")
+        #end if
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != VERSION:
+            self.db.execute("DROP TABLE IF EXISTS images")
+            self.db.execute("PRAGMA user_version = {}".format(VERSION))
+        #end if
+        self.db.execute("""CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+            fingerprint TEXT, time INTEGER, tracks TEXT, outcome TEXT, processed REAL)""")
+        self.skipped = 0
+    #end def
+
+    # tracks: Tracks of this run
+    def unchanged(self, image, fingerprint, tracks):
+        try:
+            st = os.stat(image)
+        except OSError:
+            return False
+        #end try
+        row = self.db.execute("SELECT size, mtime, fingerprint, time, tracks FROM images WHERE path = ?",
+            (os.path.abspath(image),)).fetchone()
+        if row is None or tuple(row[:3]) != (st.st_size, st.st_mtime_ns, fingerprint):
+            return False
+        #end if
+        if tracks.fingerprint(row[3]) != row[4]:
+            return False
+        #end if
+        self.skipped += 1
+        return True
+    #end def
+
+    # records: list of (image, outcome, photo time or None)
+    def record(self, records, fingerprint, tracks):
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        for image, outcome, t in records:
+            try:
+                st = os.stat(image)
+            except OSError:
+                continue
+            #end try
+            self.db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(image), st.st_size, st.st_mtime_ns, fingerprint, t, tracks.fingerprint(t), outcome, now))
+        #end for
+        self.db.execute("COMMIT")
+    #end def
+#end class
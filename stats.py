@@ -0,0 +1,116 @@
+#===============================================================================
+# Lightweight instrumentation for gpxcorrelate. Functions are wrapped with
+# @timed("name") and events are counted with count("name"). Nothing is
+# recorded until enable() is called; while disabled, a wrapped call costs one
+# extra function call and a flag check.
+# The startup profile (import and initialization time per subsystem) is always
+# recorded, since most of it happens before the options are parsed.
+#===============================================================================
+import sys
+import json
+import time
+import threading
+import functools
+import importlib
+
+enabled = False
+timers = {}
+counters = {}
+startup = {}
+lock = threading.Lock()
+
+def enable():
+    global enabled
+    enabled = True
+#end def
+
+def add_time(name, seconds, calls=1):
+    with lock:
+        timer = timers.setdefault(name, [0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+    #end with
+#end def
+
+def count(name, n=1):
+    if not enabled:
+        return
+    #end if
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+    #end with
+#end def
+
+# Records the time since t0 (time.perf_counter()) in the startup profile.
+def started(name, t0):
+    with lock:
+        startup[name] = startup.get(name, 0.0) + time.perf_counter() - t0
+    #end with
+#end def
+
+# Imports a module on first use and records the import time in the startup
+# profile.
+def load(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    #end if
+    t0 = time.perf_counter()
+    module = importlib.import_module(name)
+    started("import " + name, t0)
+    return module
+#end def
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            #end if
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - t0)
+            #end try
+        #end def
+        return wrapper
+    #end def
+    return decorator
+#end def
+
+# extra: dict of section name -> dict of values, e.g. cache statistics or the
+# histogram of correlation states
+def summary(extra=None):
+    result = {
+        "timers": dict((name, {"calls": t[0], "seconds": round(t[1], 6)}) for name, t in sorted(timers.items())),
+        "counters": dict(sorted(counters.items())),
+        "startup": dict((name, round(seconds, 6)) for name, seconds in startup.items()),
+    }
+    if extra:
+        result.update(extra)
+    #end if
+    return result
+#end def
+
+def report(fmt="text", extra=None):
+    result = summary(extra)
+    if fmt == "json":
+        return json.dumps(result, indent=1)
+    #end if
+    lines = ["{:24s} {:>8s} {:>10s} {:>10s}".format("timer", "calls", "total s", "mean ms")]
+    for name, t in result["timers"].items():
+        lines.append("{:24s} {:8d} {:10.3f} {:10.3f}".format(name, t["calls"], t["seconds"], 1000.0 * t["seconds"] / max(t["calls"], 1)))
+    #end for
+    for section, values in result.items():
+        if section == "timers" or not values:
+            continue
+        #end if
+        lines.append("")
+        lines.append(section)
+        for name, value in values.items():
+            lines.append("  {:22s} {}".format(name, value))
+        #end for
+    #end for
+    return "\n".join(lines)
+#end def
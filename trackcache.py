@@ -0,0 +1,204 @@
+#===============================================================================
+# Persistent cache of parsed gpx tracks for gpxcorrelate.
+# Every gpx file gets one cache file in ~/.cache/gpxcorrelate/tracks, named
+# after a hash of its path, the requested extension tags and the
+# simplification tolerance. A cache file is
+# a small json header (source size and mtime, tags, segment layout) followed
+# by the raw int64/float64 columns of all segments: times, lons, lats, eles
+# and one float64 column per tag, in sorted tag order. Loading memory-maps the
+# file and hands out memoryviews on the columns, so there is no decode step.
+# An entry is only used if the size and mtime of the gpx file still match.
+# The total cache size is limited; the least recently used entries are
+# removed first.
+#===============================================================================
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import stats
+
+MAGIC = b"GPXC"
+VERSION = 2
+HEADER = struct.Struct("<4sII")
+
+def align(n):
+    return (n + 7) & ~7
+#end def
+
+class TrackCache:
+    def __init__(self, limit=256*1024*1024, path=None):
+        if path is None:
+            path = os.path.join(os.environ["HOME"], ".cache", "gpxcorrelate", "tracks")
+        #end if
+        self.path = path
+        self.limit = limit
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError:
+            logging.warn("could not create {}. Track cache disabled.".format(self.path))
+            self.enabled = False
+        #end try
+        # running size of the cache, so a store only scans the directory when
+        # the limit is exceeded
+        self.total = sum(size for mtime, size, path in self.entries()) if self.enabled else 0
+    #end def
+
+    def filename(self, gpxfile, tags, simplify=0):
+        key = "\0".join([os.path.abspath(gpxfile)] + sorted(tags))
+        if simplify:
+            key += "\0simplify={}".format(simplify)
+        #end if
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".trk")
+    #end def
+
+    # Returns a list of (times, lons, lats, eles, data) tuples, data being a
+    # dict of tag -> column, or None if the file is not cached or the cache
+    # entry is out of date.
+    @stats.timed("trackcache_load")
+    def load(self, gpxfile, tags, simplify=0):
+        if not self.enabled:
+            return None
+        #end if
+        cachefile = self.filename(gpxfile, tags, simplify)
+        try:
+            st = os.stat(gpxfile)
+            with open(cachefile, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            #end with
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        #end try
+        try:
+            magic, version, hlen = HEADER.unpack_from(buf, 0)
+            header = json.loads(bytes(buf[HEADER.size:HEADER.size+hlen]).decode("utf-8"))
+        except (struct.error, ValueError):
+            magic = version = header = None
+        #end try
+        if (magic != MAGIC or version != VERSION or header["size"] != st.st_size
+                or header["mtime"] != st.st_mtime_ns or header["byteorder"] != sys.byteorder
+                or header["tags"] != sorted(tags) or header.get("simplify", 0) != simplify):
+            buf.close()
+            self.misses += 1
+            return None
+        #end if
+        view = memoryview(buf)
+        offset = align(HEADER.size + hlen)
+        segments = []
+        for seg in header["segments"]:
+            n = seg["n"]
+            columns = []
+            for fmt in "qddd":
+                columns.append(view[offset:offset+8*n].cast(fmt))
+                offset += 8 * n
+            #end for
+            data = {}
+            for tag in header["tags"]:
+                data[tag] = view[offset:offset+8*n].cast("d")
+                offset += 8 * n
+            #end for
+            segments.append(tuple(columns) + (data,))
+        #end for
+        self.hits += 1
+        try:
+            os.utime(cachefile)
+        except OSError:
+            pass
+        #end try
+        return segments
+    #end def
+
+    # segments: list of (times, lons, lats, eles, data) with array columns
+    @stats.timed("trackcache_store")
+    def store(self, gpxfile, tags, segments, simplify=0):
+        if not self.enabled:
+            return
+        #end if
+        try:
+            st = os.stat(gpxfile)
+        except OSError:
+            return
+        #end try
+        header = {
+            "path": os.path.abspath(gpxfile),
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "byteorder": sys.byteorder,
+            "tags": sorted(tags),
+            "simplify": simplify,
+            "segments": [{"n": len(seg[0])} for seg in segments],
+        }
+        hbytes = json.dumps(header).encode("utf-8")
+        cachefile = self.filename(gpxfile, tags, simplify)
+        tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+        try:
+            with open(tmpfile, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION, len(hbytes)))
+                f.write(hbytes)
+                f.write(b"\0" * (align(HEADER.size + len(hbytes)) - HEADER.size - len(hbytes)))
+                for seg in segments:
+                    for column in list(seg[:4]) + [seg[4][tag] for tag in sorted(tags)]:
+                        f.write(column.tobytes() if hasattr(column, "tobytes") else bytes(column))
+                    #end for
+                #end for
+                size = f.tell()
+            #end with
+            try:
+                size -= os.stat(cachefile).st_size
+            except OSError:
+                pass
+            #end try
+            os.replace(tmpfile, cachefile)
+        except OSError as e:
+            logging.warn("{}: could not write track cache ({}).".format(gpxfile, e))
+            try: os.unlink(tmpfile)
+            except OSError: pass
+            return
+        #end try
+        self.total += size
+        if self.total > self.limit:
+            self.evict()
+        #end if
+    #end def
+
+    # (mtime, size, path) of all cache files
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(".trk"):
+                continue
+            #end if
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            #end try
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        #end for
+        return entries
+    #end def
+
+    # Removes the least recently used entries until the cache is 10% below
+    # its limit, so a full cache is not scanned again on every store.
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        while total > self.limit * 0.9 and len(entries) > 1:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+                logging.debug("track cache: evicted {}".format(path))
+            except OSError:
+                pass
+            #end try
+            total -= size
+        #end while
+        self.total = total
+    #end def
+#end class
@@ -0,0 +1,72 @@
+#===============================================================================
+# Polling file watcher for the watch mode of gpxcorrelate. The watched paths
+# are files or directories (not recursive). Every poll() lists the directories
+# with os.scandir and compares size and mtime of each file to the previous
+# poll: a file is handed out once it was seen with the same size and mtime in
+# two consecutive polls, so files still being copied are left alone. A file
+# is handed out again only after it changed; done() records the state after
+# processing, so changes made by gpxcorrelate itself (e.g. exiv2 writing into
+# the image) do not trigger a second run.
+#===============================================================================
+import os
+import logging
+
+class Watcher:
+    # accept: function filename -> bool, applied to directory entries only
+    def __init__(self, paths, accept=None):
+        self.paths = list(paths)
+        self.accept = accept or (lambda name: True)
+        self.seen = {}
+        self.handled = {}
+    #end def
+
+    def scan(self, warn=False):
+        files = {}
+        for path in self.paths:
+            try:
+                if os.path.isdir(path):
+                    for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                        if entry.is_file() and self.accept(entry.name):
+                            st = entry.stat()
+                            files[entry.path] = (st.st_size, st.st_mtime_ns)
+                        #end if
+                    #end for
+                else:
+                    st = os.stat(path)
+                    files[path] = (st.st_size, st.st_mtime_ns)
+                #end if
+            except OSError as e:
+                if warn:
+                    logging.warn("{}: {} - skipped.".format(path, e.strerror))
+                #end if
+            #end try
+        #end for
+        return files
+    #end def
+
+    # Files present now in the order of the watched paths, regardless of
+    # whether they are stable; used for the files given at startup.
+    def files(self):
+        self.seen = self.scan(warn=True)
+        return list(self.seen)
+    #end def
+
+    # Returns the files that are new or changed and stable since the last poll.
+    def poll(self):
+        files = self.scan()
+        ready = [path for path, state in files.items() if self.seen.get(path) == state and self.handled.get(path) != state]
+        self.seen = files
+        return sorted(ready)
+    #end def
+
+    def done(self, paths):
+        for path in paths:
+            try:
+                st = os.stat(path)
+                self.handled[path] = self.seen[path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                self.handled.pop(path, None)
+            #end try
+        #end for
+    #end def
+#end class